@@ -7,6 +7,7 @@ from rest_framework.exceptions import AuthenticationFailed
 from rest_framework import viewsets
 from rest_framework.parsers import MultiPartParser, FormParser
 from api.token_blacklist import add_to_blacklist, is_token_revoked
+from store.guest_basket import merge_guest_basket
 from store.views import get_user_from_token
 from .models import   User
 from .serializers import   UserImageSerializer, UserSerializer
@@ -43,19 +44,23 @@ class CustomLoginView(View):
             data = json.loads(request.body.decode('utf-8'))
             username = data.get('username')
             password = data.get('password')
+            cart_token = data.get('cart_token')
             print('trying to login : ', username, 'and pass ',password)
             # Process the data as needed
         except:
             username = request.POST.get('username')
             password = request.POST.get('password')
+            cart_token = request.POST.get('cart_token')
 
         user = authenticate(username=username, password=password)
 
         if user is not None:
             login(request, user)
             token = jwt_encode_handler(jwt_payload_handler(user))
+            # Carry the guest basket over to the user's own basket
+            basket = merge_guest_basket(user, cart_token) if cart_token else None
             print(f"'positionTitle':{user.job_position_title} , 'PoditionDescription':{user.position_title}")
-            return JsonResponse({'message': 'Login successful', 'token': token, 'username': username, 'positionTitle':user.job_position_title , 'PoditionDescription':user.position_title}, status=200)
+            return JsonResponse({'message': 'Login successful', 'token': token, 'username': username, 'positionTitle':user.job_position_title , 'PoditionDescription':user.position_title, 'basket_id': basket.id if basket else None}, status=200)
         else:
             print('failed')
             return JsonResponse({'message': 'Invalid username or password'}, status=401)
@@ -102,9 +102,43 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # A file (not in-memory) test database so concurrency tests block on
+        # SQLite's lock instead of failing with "table is locked"
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# The catalog version is kept in the database, so a process-local cache still
+# sees invalidations from other workers within a few seconds. A shared backend
+# (file, redis, ...) additionally lets workers share snapshots and guest baskets.
+# Guest baskets are user data, so they get their own cache where catalog
+# snapshots can never evict them.
+
+# Guest baskets live in the cache only and expire after this many seconds
+GUEST_BASKET_TTL = int(os.getenv('GUEST_BASKET_TTL', str(60 * 60 * 24 * 7)))
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'ecommerce-api'),
+    },
+    'guest_baskets': {
+        'BACKEND': os.getenv('GUEST_BASKET_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('GUEST_BASKET_CACHE_LOCATION', 'ecommerce-api-guest-baskets'),
+        'TIMEOUT': GUEST_BASKET_TTL,
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('GUEST_BASKET_MAX_ENTRIES', '100000')),
+        },
+    },
+}
+
+# Baskets untouched for this many days are removed by purge_abandoned_baskets
+BASKET_RETENTION_DAYS = int(os.getenv('BASKET_RETENTION_DAYS', '30'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -144,6 +178,9 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
+
+# Background threads resizing uploaded product images (0 = resize inline)
+IMAGE_RENDITION_WORKERS = int(os.getenv('IMAGE_RENDITION_WORKERS', '2'))
 from datetime import datetime, timedelta
 
 # Static files (CSS, JavaScript, Images)
@@ -156,6 +193,17 @@ JWT_EXPIRATION_DELTA = timedelta(days=7)
 # MyFatoorah API
 MYFATOORAH_API_URL = os.getenv('MYFATOORAH_API_URL')
 MYFATOORAH_API_KEY = os.getenv('MYFATOORAH_API_KEY')
+MYFATOORAH_TIMEOUT = int(os.getenv('MYFATOORAH_TIMEOUT', '15'))  # Seconds per gateway request
+# Background threads creating payment invoices after checkout. The default 0
+# calls the gateway inline once the order has committed: on serverless hosts
+# (vercel.json) threads are frozen after the response, so queued invoices would
+# stay pending. Only raise it on long-running servers (Procfile).
+PAYMENT_WORKERS = int(os.getenv('PAYMENT_WORKERS', '0'))
+PAYMENT_MAX_ATTEMPTS = int(os.getenv('PAYMENT_MAX_ATTEMPTS', '5'))
+# Stored responses for Idempotency-Key retries are kept this many seconds
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', str(60 * 60 * 24)))
+# A request still running after this many seconds is assumed dead and its key can be retried
+IDEMPOTENCY_LEASE = int(os.getenv('IDEMPOTENCY_LEASE', str(60 * 5)))
 
 # PayMob API
 PAYMOB_API_KEY = os.getenv('PAYMOB_API_KEY')
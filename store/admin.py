@@ -1,7 +1,8 @@
 # api/admin.py
 
 from django.contrib import admin
-from .models import Address, City, KeyFeature, Payment, Product, Basket, BasketItem, Coupon, Order, OrderItem
+from .models import Address, City, KeyFeature, Payment, PaymentRequest, Product, Basket, BasketItem, Coupon, Order, OrderItem
+from .orders import BULK_TRANSITION_MAX, transition_orders
 
 
 class BasketItemInline(admin.TabularInline):
@@ -36,6 +37,10 @@ class BasketAdmin(admin.ModelAdmin):
     list_filter = ('user', 'created_at')
     search_fields = ('user__username',)
     inlines = [BasketItemInline]
+    list_select_related = ('user',)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_totals()
 
     def total_items(self, obj):
         return obj.total_items()
@@ -64,13 +69,23 @@ class OrderAdmin(admin.ModelAdmin):
     inlines = [OrderItemInline]
     actions = ['mark_as_paid', 'mark_as_received']
 
+    def apply_transition(self, request, queryset, transition):
+        # Same rules and SQL timestamps as the bulk transitions endpoint, in
+        # chunks the endpoint accepts so "select all" works on any number of orders
+        order_ids = list(queryset.values_list('id', flat=True))
+        outcomes = []
+        for start in range(0, len(order_ids), BULK_TRANSITION_MAX):
+            outcomes += transition_orders(order_ids[start:start + BULK_TRANSITION_MAX], transition)
+        updated = sum(1 for outcome in outcomes if outcome['status'] == 'updated')
+        self.message_user(request, f'{updated} of {len(outcomes)} orders updated')
+
     def mark_as_paid(self, request, queryset):
-        queryset.update(paid=True, payment_status='completed')
+        self.apply_transition(request, queryset, 'pay')
     
     mark_as_paid.short_description = 'Mark selected orders as paid'
 
     def mark_as_received(self, request, queryset):
-        queryset.update(received=True)
+        self.apply_transition(request, queryset, 'receive')
     
     mark_as_received.short_description = 'Mark selected orders as received'
 
@@ -118,4 +133,9 @@ class CityAdmin(admin.ModelAdmin):
 @admin.register(Address)
 class AddressAdmin(admin.ModelAdmin):
     list_display = ['address_line', 'city', 'state', 'country', 'postal_code']
-    search_fields = ['address_line', 'city__name', 'state', 'country', 'postal_code']
\ No newline at end of file
+    search_fields = ['address_line', 'city__name', 'state', 'country', 'postal_code']
+@admin.register(PaymentRequest)
+class PaymentRequestAdmin(admin.ModelAdmin):
+    list_display = ['order', 'status', 'attempts', 'created_at', 'updated_at']
+    list_filter = ['status']
+    readonly_fields = ['payment_url', 'error']
@@ -0,0 +1,83 @@
+import hashlib
+
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags, urlencode
+from rest_framework.renderers import JSONRenderer
+
+from .filters import FACETS
+from .models import Sequence
+
+CATALOG_VERSION_SEQUENCE = 'catalog_version'
+CATALOG_VERSION_KEY = 'catalog:version'
+# The version itself lives in the database so every worker sees a bump; each
+# process only trusts its cached copy this long, which bounds how stale a
+# snapshot served by another worker can be even with a process-local cache
+CATALOG_VERSION_TIMEOUT = 5
+CATALOG_SNAPSHOT_TIMEOUT = 60 * 60 * 24
+# Query parameters the catalog reads; any others share the same snapshot
+CATALOG_QUERY_PARAMS = ('cursor', 'page_size', 'fields', 'omit', 'ordering', 'min_price', 'max_price', *FACETS)
+
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        version = Sequence.objects.filter(name=CATALOG_VERSION_SEQUENCE).values_list('value', flat=True).first() or 0
+        cache.set(CATALOG_VERSION_KEY, version, timeout=CATALOG_VERSION_TIMEOUT)
+    return version
+
+
+def bump_catalog_version():
+    """
+    Invalidate every catalog snapshot by moving to a new catalog version.
+    Old snapshots are never read again and expire from the cache on their own.
+    """
+    version = Sequence.next_value(CATALOG_VERSION_SEQUENCE)
+    cache.set(CATALOG_VERSION_KEY, version, timeout=CATALOG_VERSION_TIMEOUT)
+
+
+def invalidate_catalog():
+    # Bump once the change is visible to other connections; until then only
+    # drop the cached version so this process rereads it after the commit.
+    cache.delete(CATALOG_VERSION_KEY)
+    transaction.on_commit(bump_catalog_version)
+
+
+def get_snapshot_key(request, version):
+    # Hosts matter because image fields are rendered as absolute URLs
+    params = sorted((name, request.GET.getlist(name)) for name in CATALOG_QUERY_PARAMS if name in request.GET)
+    identity = f'{request.get_host()}{request.path}?{urlencode(params, doseq=True)}'
+    digest = hashlib.sha1(identity.encode('utf-8')).hexdigest()
+    return f'catalog:snapshot:{version}:{digest}'
+
+
+def build_snapshot(data):
+    body = JSONRenderer().render(data)
+    etag = '"%s"' % hashlib.sha256(body).hexdigest()
+    return {'etag': etag, 'body': body}
+
+
+def catalog_snapshot_response(request, render_data):
+    """
+    Serve a catalog response from its prebuilt snapshot.
+
+    :param request: The incoming request
+    :param render_data: Callable returning the serialized catalog data, only
+        called when no snapshot exists for the current catalog version
+    :return: 304 when If-None-Match matches the snapshot ETag, otherwise the
+        snapshot body with its ETag
+    """
+    key = get_snapshot_key(request, get_catalog_version())
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = build_snapshot(render_data())
+        cache.set(key, snapshot, timeout=CATALOG_SNAPSHOT_TIMEOUT)
+
+    if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    if snapshot['etag'] in if_none_match or '*' in if_none_match:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(snapshot['body'], content_type='application/json')
+    response['ETag'] = snapshot['etag']
+    return response
@@ -0,0 +1,202 @@
+from datetime import datetime, time, timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db.models import Count, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend, OrderingFilter
+
+
+def parse_price(request, name):
+    value = request.query_params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        price = Decimal(value)
+    except InvalidOperation:
+        raise ValidationError({name: 'Must be a number.'})
+    if not price.is_finite() or price < 0:
+        raise ValidationError({name: 'Must be a positive number.'})
+    return price
+
+
+class ProductPriceFilter(BaseFilterBackend):
+    # ?min_price= / ?max_price= on the indexed effective_price column
+    def filter_queryset(self, request, queryset, view):
+        min_price = parse_price(request, 'min_price')
+        max_price = parse_price(request, 'max_price')
+        if min_price is not None:
+            queryset = queryset.filter(effective_price__gte=min_price)
+        if max_price is not None:
+            queryset = queryset.filter(effective_price__lte=max_price)
+        return queryset
+
+
+class ProductOrderingFilter(OrderingFilter):
+    # ?ordering=effective_price / -effective_price, ties broken by position so
+    # cursor pagination stays stable
+    ordering_fields = ['position', 'effective_price']
+
+    def get_ordering(self, request, queryset, view):
+        ordering = list(super().get_ordering(request, queryset, view) or ['position'])
+        if 'position' not in ordering and '-position' not in ordering:
+            ordering.append('position')
+        return ordering
+
+
+PRICE_BUCKETS = [(0, 100), (100, 250), (250, 500), (500, 1000), (1000, None)]
+
+
+def price_bucket_key(low, high):
+    return f'{low}+' if high is None else f'{low}-{high}'
+
+
+def price_bucket_filter(low, high):
+    bucket = Q(effective_price__gte=low)
+    if high is not None:
+        bucket &= Q(effective_price__lt=high)
+    return bucket
+
+
+ON_OFFER = Q(offer_price__isnull=False) & Q(offer_price__gt=0)
+
+# facet: {value: filter}
+FACETS = {
+    'in_stock': {'true': Q(inventory_count__gt=0), 'false': Q(inventory_count=0)},
+    'is_active': {'true': Q(is_active=True), 'false': Q(is_active=False)},
+    'on_offer': {'true': ON_OFFER, 'false': ~ON_OFFER},
+    'price_bucket': {price_bucket_key(low, high): price_bucket_filter(low, high) for low, high in PRICE_BUCKETS},
+}
+
+# The storefront only shows active, in-stock products unless asked otherwise
+FACET_DEFAULTS = {'in_stock': 'true', 'is_active': 'true'}
+
+
+def selected_facets(request):
+    """
+    Read the facet selection from the query string.
+
+    Values are comma separated and OR-ed within a facet; `any` disables a
+    facet that has a default.
+
+    :return: Dict mapping facet name to its combined filter
+    """
+    selection = {}
+    for facet, values in FACETS.items():
+        raw = request.query_params.get(facet, FACET_DEFAULTS.get(facet))
+        if raw in (None, '', 'any'):
+            continue
+        combined = Q()
+        for value in raw.split(','):
+            value = value.strip().lower()
+            if value not in values:
+                raise ValidationError({facet: f'Must be one of: {", ".join(values)}, any.'})
+            combined |= values[value]
+        selection[facet] = combined
+    return selection
+
+
+class ProductFacetFilter(BaseFilterBackend):
+    def filter_queryset(self, request, queryset, view):
+        for facet_filter in selected_facets(request).values():
+            queryset = queryset.filter(facet_filter)
+        return queryset
+
+
+def facet_counts(queryset, request):
+    """
+    Count products for every facet value in a single aggregate query.
+
+    Each facet is counted under the selection of the *other* facets, so a
+    client can see how many results picking another value would give.
+
+    :param queryset: Products already narrowed by non-facet filters (price range)
+    :param request: Request carrying the facet selection
+    :return: Dict of {facet: {value: count}}
+    """
+    selection = selected_facets(request)
+    aggregates = {}
+    for facet, values in FACETS.items():
+        others = Q()
+        for other, other_filter in selection.items():
+            if other != facet:
+                others &= other_filter
+        for value, value_filter in values.items():
+            aggregates[f'{facet}__{value}'] = Count('id', filter=others & value_filter)
+
+    totals = queryset.order_by().aggregate(**aggregates)
+    counts = {facet: {} for facet in FACETS}
+    for key, total in totals.items():
+        facet, value = key.split('__', 1)
+        counts[facet][value] = total
+    return counts
+
+
+ORDER_FLAGS = ('paid', 'packaged', 'delivered', 'received', 'printed')
+ORDER_PAYMENT_STATUSES = ('pending', 'completed', 'canceled')
+
+
+def parse_flag(request, name):
+    value = request.query_params.get(name)
+    if value in (None, '', 'any'):
+        return None
+    value = value.strip().lower()
+    if value not in ('true', 'false'):
+        raise ValidationError({name: 'Must be true, false or any.'})
+    return value == 'true'
+
+
+def parse_datetime_param(request, name, end_of_day=False):
+    """
+    Read an ISO date or datetime from the query string.
+
+    A bare date means the start of that day, or the start of the next one
+    when `end_of_day` is set, so ?created_before=2024-05-31 includes the 31st.
+    """
+    value = request.query_params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        day = parse_date(value)
+        if day is not None:
+            moment = datetime.combine(day + timedelta(days=1) if end_of_day else day, time.min)
+        else:
+            moment = parse_datetime(value)
+            if moment is None:
+                raise ValueError
+    except ValueError:
+        raise ValidationError({name: 'Must be an ISO date or datetime.'})
+    if settings.USE_TZ and timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+class OrderStatusFilter(BaseFilterBackend):
+    """
+    ?paid= / ?packaged= / ?delivered= / ?received= / ?printed= (true/false),
+    ?payment_status=pending,completed and ?created_after= / ?created_before=.
+
+    The combinations used by the back office are served by the Order indexes.
+    """
+    def filter_queryset(self, request, queryset, view):
+        for flag in ORDER_FLAGS:
+            value = parse_flag(request, flag)
+            if value is not None:
+                queryset = queryset.filter(**{flag: value})
+
+        raw = request.query_params.get('payment_status')
+        if raw not in (None, '', 'any'):
+            statuses = {value.strip().lower() for value in raw.split(',')}
+            if not statuses <= set(ORDER_PAYMENT_STATUSES):
+                raise ValidationError({'payment_status': f'Must be one of: {", ".join(ORDER_PAYMENT_STATUSES)}, any.'})
+            queryset = queryset.filter(payment_status__in=sorted(statuses))
+
+        created_after = parse_datetime_param(request, 'created_after')
+        created_before = parse_datetime_param(request, 'created_before', end_of_day=True)
+        if created_after is not None:
+            queryset = queryset.filter(created_at__gte=created_after)
+        if created_before is not None:
+            queryset = queryset.filter(created_at__lt=created_before)
+        return queryset
@@ -0,0 +1,84 @@
+import secrets
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import Basket, Product
+
+GUEST_BASKET_PREFIX = 'guest-basket'
+GUEST_BASKET_CACHE = 'guest_baskets'
+
+
+def guest_basket_cache():
+    # A cache of its own, so catalog traffic never evicts a shopper's basket
+    return caches[GUEST_BASKET_CACHE]
+
+
+def guest_basket_key(token):
+    return f'{GUEST_BASKET_PREFIX}:{token}'
+
+
+def create_guest_basket():
+    """
+    Start an empty guest basket and return its opaque token.
+    Guest baskets only live in the guest basket cache and expire after GUEST_BASKET_TTL.
+    """
+    token = secrets.token_urlsafe(24)
+    guest_basket_cache().set(guest_basket_key(token), {}, timeout=settings.GUEST_BASKET_TTL)
+    return token
+
+
+def get_guest_basket(token):
+    # None when the token is unknown or the basket expired
+    if not token:
+        return None
+    return guest_basket_cache().get(guest_basket_key(token))
+
+
+def save_guest_basket(token, lines):
+    # Every write renews the TTL so active shoppers keep their basket
+    guest_basket_cache().set(guest_basket_key(token), lines, timeout=settings.GUEST_BASKET_TTL)
+
+
+def add_guest_items(token, lines):
+    """
+    Add quantities to a guest basket.
+
+    :param token: Guest basket token
+    :param lines: Dict mapping product id to the quantity to add
+    :return: The updated basket lines, or None if the basket does not exist
+    """
+    basket = get_guest_basket(token)
+    if basket is None:
+        return None
+    for product_id, quantity in lines.items():
+        basket[product_id] = basket.get(product_id, 0) + quantity
+    save_guest_basket(token, basket)
+    return basket
+
+
+def delete_guest_basket(token):
+    guest_basket_cache().delete(guest_basket_key(token))
+
+
+def merge_guest_basket(user, token):
+    """
+    Move a guest basket into the user's persistent basket with one upsert.
+
+    :param user: The user who just logged in
+    :param token: Guest basket token
+    :return: The user's Basket, or None if there was nothing to merge
+    """
+    lines = get_guest_basket(token)
+    if not lines:
+        return None
+    # Products may have been deleted while the basket sat in the cache
+    existing = set(Product.objects.filter(id__in=lines.keys()).values_list('id', flat=True))
+    lines = {product_id: quantity for product_id, quantity in lines.items() if product_id in existing}
+
+    basket = Basket.objects.filter(user=user).order_by('-updated_at').first()
+    if basket is None:
+        basket = Basket.objects.create(user=user)
+    basket.add_items(lines)
+    delete_guest_basket(token)
+    return basket
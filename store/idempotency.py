@@ -0,0 +1,87 @@
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from .models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyError(Exception):
+    """
+    The key cannot be used for this request: it is still running, or it was
+    first used with a different payload.
+    """
+
+    def __init__(self, message, status_code):
+        self.status_code = status_code
+        super().__init__(message)
+
+
+def digest(value):
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
+def begin_request(scope, key, owner, payload):
+    """
+    Claim an idempotency key before running a request.
+
+    :param scope: What the key protects, e.g. 'order-create'
+    :param key: Client supplied key
+    :param owner: Who the key belongs to (user id, order id), so keys never collide across owners
+    :param payload: Request data; reusing a key with other data is rejected
+    :return: The IdempotencyKey; its `response` is set when this is a replay
+    :raises IdempotencyError: When the key is invalid, in use, or used for other data
+    """
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise IdempotencyError(f'{IDEMPOTENCY_HEADER} must be 1 to {MAX_KEY_LENGTH} characters', 400)
+    key_hash = digest(f'{owner}:{key}')
+    request_hash = digest(json.dumps(payload, sort_keys=True, default=str))
+    now = timezone.now()
+
+    for _ in range(2):
+        try:
+            with transaction.atomic():
+                return IdempotencyKey.objects.create(
+                    scope=scope,
+                    key_hash=key_hash,
+                    request_hash=request_hash,
+                    # Short lease while running; complete_request extends it to the TTL
+                    expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_LEASE),
+                )
+        except IntegrityError:
+            existing = IdempotencyKey.objects.filter(scope=scope, key_hash=key_hash).first()
+            if existing is None or existing.expires_at <= now:
+                # Expired response, lease of a dead request, or just released:
+                # drop it and claim the key again
+                IdempotencyKey.objects.filter(scope=scope, key_hash=key_hash, expires_at__lte=now).delete()
+                continue
+            if existing.request_hash != request_hash:
+                raise IdempotencyError(f'{IDEMPOTENCY_HEADER} was already used with a different request', 422)
+            if existing.response is None:
+                raise IdempotencyError('A request with this key is still being processed', 409)
+            return existing
+    raise IdempotencyError('A request with this key is still being processed', 409)
+
+
+def complete_request(record, status_code, data):
+    """
+    Store the outcome of a claimed request.
+
+    Successful responses are kept for replays. Failed ones release the key:
+    nothing was committed, so the client may retry with the same key.
+    """
+    if 200 <= status_code < 300:
+        # Store exactly what the client received (Decimals rendered, etc.)
+        record.response = json.loads(JSONRenderer().render(data))
+        record.status_code = status_code
+        record.expires_at = timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+        record.save(update_fields=['response', 'status_code', 'expires_at'])
+    else:
+        record.delete()
@@ -0,0 +1,93 @@
+from collections import OrderedDict
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+
+from .catalog import invalidate_catalog
+from .models import Product
+
+
+class InsufficientInventory(ValueError):
+    """
+    Raised when some order lines cannot be served; nothing was reserved.
+
+    `failures` lists one dict per failing product with the requested and
+    currently available quantity (None when the product does not exist).
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        names = ', '.join(str(failure['product_id']) for failure in failures)
+        super().__init__(f"Insufficient inventory for products: {names}")
+
+
+def merge_lines(product_ids, quantities):
+    """
+    Combine parallel product / quantity lists into {product_id: quantity},
+    adding up products that appear more than once.
+    """
+    lines = OrderedDict()
+    for product_id, quantity in zip(product_ids, quantities):
+        product_id, quantity = int(product_id), int(quantity)
+        if quantity <= 0:
+            raise ValueError(f"Quantity for product {product_id} must be positive")
+        lines[product_id] = lines.get(product_id, 0) + quantity
+    return lines
+
+
+def quantity_case(lines):
+    return Case(
+        *[When(id=product_id, then=Value(quantity)) for product_id, quantity in lines.items()],
+        output_field=IntegerField(),
+    )
+
+
+def reserve_stock(lines):
+    """
+    Take stock for every line of an order, or for none of them.
+
+    All lines are decremented by one conditional UPDATE that only touches
+    rows still holding enough stock, so concurrent checkouts can never
+    oversell and only inventory_count is written.
+
+    :param lines: Dict mapping product id to quantity
+    :raises InsufficientInventory: When any line cannot be served
+    """
+    if not lines:
+        return
+    requested = quantity_case(lines)
+    try:
+        with transaction.atomic():
+            updated = Product.objects.filter(
+                id__in=lines.keys(),
+                inventory_count__gte=requested,
+            ).update(inventory_count=F('inventory_count') - requested)
+            if updated != len(lines):
+                # Roll back the lines that did fit, then report the rest
+                raise InsufficientInventory([])
+    except InsufficientInventory:
+        raise InsufficientInventory(find_shortages(lines))
+    # Queryset updates skip the model signals
+    invalidate_catalog()
+
+
+def release_stock(lines):
+    """
+    Put reserved stock back, e.g. for a canceled order.
+
+    :param lines: Dict mapping product id to quantity
+    """
+    if not lines:
+        return
+    returned = quantity_case(lines)
+    Product.objects.filter(id__in=lines.keys()).update(inventory_count=F('inventory_count') + returned)
+    invalidate_catalog()
+
+
+def find_shortages(lines):
+    available = dict(Product.objects.filter(id__in=lines.keys()).values_list('id', 'inventory_count'))
+    return [
+        {'product_id': product_id, 'requested': quantity, 'available': available.get(product_id)}
+        for product_id, quantity in lines.items()
+        if available.get(product_id) is None or available[product_id] < quantity
+    ]
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from store.models import Product
+from store.renditions import generate_renditions, needs_renditions
+
+
+class Command(BaseCommand):
+    help = 'Generate resized renditions for product images that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Regenerate renditions for every product image')
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='').exclude(image__isnull=True).only('id', 'image', 'image_renditions')
+        generated = 0
+        for product in products.iterator():
+            if options['force']:
+                Product.objects.filter(pk=product.pk).update(image_renditions={})
+            elif not needs_renditions(product):
+                continue
+            try:
+                generate_renditions(product.pk)
+                generated += 1
+            except Exception as e:
+                self.stderr.write(f'Product {product.pk}: {e}')
+        self.stdout.write(self.style.SUCCESS(f'Generated renditions for {generated} products'))
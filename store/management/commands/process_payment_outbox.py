@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from store.payment_outbox import pending_payment_ids, process_payment
+
+
+class Command(BaseCommand):
+    help = 'Create gateway invoices for orders whose payment request is pending, failed or stuck'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None, help='Process at most this many requests')
+
+    def handle(self, *args, **options):
+        created = failed = 0
+        for payment_request_id in pending_payment_ids(options['limit']):
+            if process_payment(payment_request_id):
+                created += 1
+            else:
+                failed += 1
+        self.stdout.write(self.style.SUCCESS(f'Created {created} invoices, {failed} failed or skipped'))
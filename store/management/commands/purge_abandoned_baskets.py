@@ -0,0 +1,42 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from store.models import Basket, BasketItem
+from store.signals import bulk_catalog_changes
+
+
+class Command(BaseCommand):
+    help = 'Delete baskets that have not been updated for a while, in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.BASKET_RETENTION_DAYS, help='Idle age in days after which a basket is removed')
+        parser.add_argument('--batch-size', type=int, default=500, help='Baskets deleted per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        abandoned = Basket.objects.filter(updated_at__lt=cutoff)
+
+        if options['dry_run']:
+            baskets = abandoned.count()
+            items = BasketItem.objects.filter(basket__updated_at__lt=cutoff).count()
+            self.stdout.write(f'Would delete {baskets} baskets and {items} basket items idle since {cutoff:%Y-%m-%d %H:%M}')
+            return
+
+        baskets = items = 0
+        while True:
+            ids = list(abandoned.order_by('id').values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            # Short transactions keep the SQLite write lock free for shoppers
+            with transaction.atomic(), bulk_catalog_changes():
+                # Re-check the cutoff so a basket touched meanwhile survives
+                _, deleted = Basket.objects.filter(id__in=ids, updated_at__lt=cutoff).delete()
+            baskets += deleted.get('store.Basket', 0)
+            items += deleted.get('store.BasketItem', 0)
+
+        self.stdout.write(self.style.SUCCESS(f'Deleted {baskets} baskets and {items} basket items idle since {cutoff:%Y-%m-%d %H:%M}'))
@@ -0,0 +1,45 @@
+from django.db import migrations
+
+
+CREATE_FTS_TABLE = """
+CREATE VIRTUAL TABLE IF NOT EXISTS store_product_fts USING fts5(
+    name,
+    description,
+    features,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+)
+"""
+
+POPULATE_FTS_TABLE = """
+INSERT INTO store_product_fts (rowid, name, description, features)
+SELECT p.id, p.name, p.description,
+       COALESCE((SELECT group_concat(k.feature_text, ' ')
+                 FROM store_keyfeature k WHERE k.product_id = p.id), '')
+FROM store_product p
+"""
+
+
+def create_product_fts(apps, schema_editor):
+    # FTS5 is SQLite only; other backends fall back to LIKE searches
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(CREATE_FTS_TABLE)
+    schema_editor.execute(POPULATE_FTS_TABLE)
+
+
+def drop_product_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS store_product_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0016_alter_product_position'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_product_fts, drop_product_fts),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:52
+
+import django.db.models.functions.comparison
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0019_product_image_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='effective_price',
+            field=models.GeneratedField(db_index=True, db_persist=True, expression=django.db.models.functions.comparison.Coalesce(django.db.models.functions.comparison.NullIf('offer_price', models.Value(0)), 'price'), output_field=models.DecimalField(decimal_places=2, max_digits=10)),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0020_product_effective_price'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['is_active', 'inventory_count', 'offer_price', 'effective_price'], name='product_facets_idx'),
+        ),
+    ]
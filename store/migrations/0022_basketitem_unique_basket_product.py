@@ -0,0 +1,34 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:54
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_basket_items(apps, schema_editor):
+    # Fold repeated (basket, product) lines into one before the constraint is added
+    BasketItem = apps.get_model('store', 'BasketItem')
+    duplicates = (
+        BasketItem.objects.values('basket_id', 'product_id')
+        .annotate(lines=Count('id'), keep_id=Min('id'), total=Sum('quantity'))
+        .filter(lines__gt=1)
+    )
+    for duplicate in duplicates:
+        BasketItem.objects.filter(id=duplicate['keep_id']).update(quantity=duplicate['total'])
+        BasketItem.objects.filter(
+            basket_id=duplicate['basket_id'], product_id=duplicate['product_id'],
+        ).exclude(id=duplicate['keep_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0021_product_facets_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_basket_items, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='basketitem',
+            constraint=models.UniqueConstraint(fields=('basket', 'product'), name='unique_basket_product'),
+        ),
+    ]
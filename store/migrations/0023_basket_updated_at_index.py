@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0022_basketitem_unique_basket_product'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='basket',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
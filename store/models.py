@@ -1,33 +1,164 @@
 import json
-from django.db import models
+from decimal import Decimal
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Value
+from django.db.models.functions import Coalesce, NullIf
 
 from api.models import User
 from django.utils import timezone
 
 
+class Sequence(models.Model):
+    # Named counters handed out with a single row update, so concurrent
+    # inserts never race on MAX() + 1.
+    name = models.CharField(max_length=50, unique=True)
+    value = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name} = {self.value}"
+
+    @classmethod
+    def next_value(cls, name, count=1, initial=None):
+        """
+        Reserve `count` consecutive values and return the first one.
+
+        :param name: Counter name
+        :param count: How many values to reserve
+        :param initial: Callable returning the current high value, only used
+            the first time the counter is created
+        """
+        with transaction.atomic():
+            updated = cls.objects.filter(name=name).update(value=models.F('value') + count)
+            if not updated:
+                start = initial() if initial else 0
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(name=name, value=(start or 0) + count)
+                except IntegrityError:
+                    # Another process created the counter first
+                    cls.objects.filter(name=name).update(value=models.F('value') + count)
+            value = cls.objects.filter(name=name).values_list('value', flat=True).get()
+        return value - count + 1
+
+    @classmethod
+    def ensure_at_least(cls, name, value):
+        # Move the counter past values that were assigned explicitly
+        cls.objects.filter(name=name, value__lt=value).update(value=value)
+
 
 class Product(models.Model):
+    POSITION_SEQUENCE = 'product_position'
+
     name = models.CharField(max_length=255)
     description = models.TextField()
     price = models.DecimalField(max_digits=10, decimal_places=2)
     offer_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    # Price the customer pays, kept by the database so it can be filtered and sorted in SQL
+    effective_price = models.GeneratedField(
+        expression=Coalesce(NullIf('offer_price', Value(0)), 'price'),
+        output_field=models.DecimalField(max_digits=10, decimal_places=2),
+        db_persist=True,
+        db_index=True,
+    )
     image = models.ImageField(upload_to='products/', null=True, blank=True)
+    image_renditions = models.JSONField(default=dict, blank=True, editable=False)  # Resized copies of image, filled in by store.renditions
     inventory_count = models.PositiveIntegerField(default=0)
     is_active = models.BooleanField(default=True)
     position = models.PositiveIntegerField(unique=True, blank=True, null=True)  # Unique and optional
 
     class Meta:
         ordering = ['position']  # Add this line to order by position by default
+        indexes = [
+            # Covers the facet filters and the one-pass facet counts
+            models.Index(fields=['is_active', 'inventory_count', 'offer_price', 'effective_price'], name='product_facets_idx'),
+        ]
 
     def __str__(self):
         return self.name
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored position so save() only touches the counter when it moves
+        if 'position' in instance.__dict__:
+            instance._loaded_position = instance.position
+        return instance
+
+    def position_changed(self):
+        return self._state.adding or self.position != getattr(self, '_loaded_position', None)
+
     def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
         if self.position is None:
             # Automatically set the position to the next available value
-            max_position = Product.objects.aggregate(models.Max('position'))['position__max']
-            self.position = (max_position or 0) + 1
+            self.position = self.next_position()
+        elif (update_fields is None or 'position' in update_fields) and self.position_changed():
+            Sequence.ensure_at_least(self.POSITION_SEQUENCE, self.position)
         super().save(*args, **kwargs)  # Corrected line
-        
+        self._loaded_position = self.position
+
+    @classmethod
+    def next_position(cls, count=1):
+        # The aggregate only runs once, to seed the counter from existing rows
+        return Sequence.next_value(
+            cls.POSITION_SEQUENCE,
+            count=count,
+            initial=lambda: cls.objects.aggregate(models.Max('position'))['position__max'],
+        )
+
+    @classmethod
+    def bulk_reorder(cls, positions, batch_size=500):
+        """
+        Move many products to new positions in one transaction.
+
+        :param positions: Dict mapping product id to its new position
+        :param batch_size: Rows per batched UPDATE statement
+        :return: Number of products moved
+        """
+        if len(set(positions.values())) != len(positions):
+            raise ValueError("Each product must get a distinct position")
+
+        with transaction.atomic():
+            products = list(cls.objects.select_for_update().filter(id__in=positions.keys()).only('id'))
+            missing = set(positions) - {product.id for product in products}
+            if missing:
+                raise ValueError(f"Products not found: {sorted(missing)}")
+
+            taken = list(
+                cls.objects.filter(position__in=positions.values())
+                .exclude(id__in=positions.keys())
+                .values_list('position', flat=True)
+            )
+            if taken:
+                raise ValueError(f"Positions already used by other products: {sorted(taken)}")
+
+            # Clear the old positions first so swaps never trip the unique index
+            cls.objects.filter(id__in=positions.keys()).update(position=None)
+            for product in products:
+                product.position = positions[product.id]
+            cls.objects.bulk_update(products, ['position'], batch_size=batch_size)
+            Sequence.ensure_at_least(cls.POSITION_SEQUENCE, max(positions.values(), default=0))
+        return len(products)
+
+    @classmethod
+    def bulk_patch(cls, patches, batch_size=500):
+        """
+        Apply many partial updates with batched UPDATE statements in one transaction.
+
+        :param patches: Dict mapping product id to a dict of field values
+        :param batch_size: Rows per batched UPDATE statement
+        :return: Ids of the products that were updated
+        """
+        fields = sorted({field for patch in patches.values() for field in patch})
+        with transaction.atomic():
+            products = cls.objects.select_for_update().only('id', *fields).in_bulk(patches.keys())
+            for product_id, product in products.items():
+                for field, value in patches[product_id].items():
+                    setattr(product, field, value)
+            if fields and products:
+                cls.objects.bulk_update(products.values(), fields, batch_size=batch_size)
+        return set(products)
+
     def get_effective_price(self):
         return self.offer_price if self.offer_price else self.price
 
@@ -38,19 +169,79 @@ class KeyFeature(models.Model):
     def __str__(self):
         return self.feature_text
 
+def basket_line_price():
+    return models.Sum(
+        models.F('quantity') * models.F('product__effective_price'),
+        output_field=models.DecimalField(max_digits=12, decimal_places=2),
+    )
+
+
+class BasketQuerySet(models.QuerySet):
+    def with_totals(self):
+        # Totals for every basket of a list page in the same query
+        return self.annotate(
+            annotated_total_items=models.Count('items'),
+            annotated_total_price=models.Sum(
+                models.F('items__quantity') * models.F('items__product__effective_price'),
+                output_field=models.DecimalField(max_digits=12, decimal_places=2),
+            ),
+        )
+
+
 class Basket(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)  # Indexed for the abandoned basket sweep
+
+    objects = BasketQuerySet.as_manager()
 
     def __str__(self):
         return f"Basket {self.id} - {self.user.username}"
 
+    def totals(self):
+        """
+        Number of lines and price of the basket, from the list annotation when
+        present, else from one aggregate query.
+        """
+        if hasattr(self, 'annotated_total_items'):
+            return {'total_items': self.annotated_total_items, 'total_price': self.annotated_total_price or Decimal('0')}
+        totals = self.items.aggregate(total_items=models.Count('id'), total_price=basket_line_price())
+        totals['total_price'] = totals['total_price'] or Decimal('0')
+        return totals
+
     def total_items(self):
-        return self.items.count()  # Calculate total items in basket
+        return self.totals()['total_items']  # Calculate total items in basket
 
     def total_price(self):
-        return sum(item.subtotal() for item in self.items.all())
+        return self.totals()['total_price']
+
+    def add_items(self, lines):
+        """
+        Add quantities to the basket in one upsert: new products get a line,
+        existing lines are incremented in the database, so concurrent adds
+        merge instead of overwriting each other.
+
+        :param lines: Dict mapping product id to the quantity to add
+        :raises ValueError: When a quantity is not positive
+        """
+        if not lines:
+            return
+        for product_id, quantity in lines.items():
+            if int(quantity) <= 0:
+                raise ValueError(f"Quantity for product {product_id} must be positive")
+        table = BasketItem._meta.db_table
+        values = ', '.join(['(%s, %s, %s)'] * len(lines))
+        params = []
+        for product_id, quantity in lines.items():
+            params += [self.pk, product_id, quantity]
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO {table} (basket_id, product_id, quantity) VALUES {values} '
+                    f'ON CONFLICT (basket_id, product_id) DO UPDATE SET quantity = {table}.quantity + excluded.quantity',
+                    params,
+                )
+            Basket.objects.filter(pk=self.pk).update(updated_at=timezone.now())
 
 
 class BasketItem(models.Model):
@@ -58,6 +249,11 @@ class BasketItem(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['basket', 'product'], name='unique_basket_product'),
+        ]
+
     def __str__(self):
         return f"{self.quantity} x {self.product.name} in Basket {self.basket.id}"
 
@@ -127,6 +323,18 @@ class Order(models.Model):
     payment_method = models.CharField(max_length=20, choices=PAYMENT_METHOD_CHOICES, default='online')
     shipping_address = models.ForeignKey(Address, null=True, blank=True, on_delete=models.SET_NULL)
 
+    class Meta:
+        indexes = [
+            # Back office lists and sales charts: status plus a date range
+            models.Index(fields=['payment_status', 'created_at'], name='order_status_created_idx'),
+            models.Index(fields=['created_at'], name='order_created_idx'),
+            # Packing and delivery queues only ever look at the open orders
+            models.Index(fields=['created_at', 'paid'], condition=models.Q(packaged=False), name='order_unpackaged_idx'),
+            models.Index(fields=['created_at'], condition=models.Q(delivered=False), name='order_undelivered_idx'),
+            # Customer order history, paginated on (created_at, id)
+            models.Index(fields=['user', 'created_at'], name='order_user_created_idx'),
+        ]
+
     def __str__(self):
         return f"Order {self.id} - {self.user.username}"
     def get_address_point(self):
@@ -147,17 +355,17 @@ class Order(models.Model):
     def mark_as_received(self):
         self.received = True
         self.received_at = timezone.now()
-        self.save()
+        self.save(update_fields=['received', 'received_at'])
 
     def mark_as_delivered(self):
         self.delivered = True
         self.delivered_at = timezone.now()
-        self.save()
+        self.save(update_fields=['delivered', 'delivered_at'])
 
     def mark_as_packaged(self):
         self.packaged = True
         self.packaged_at = timezone.now()
-        self.save()
+        self.save(update_fields=['packaged', 'packaged_at'])
 
     def save(self, *args, **kwargs):
         if self.received and self.received_at is None:
@@ -196,6 +404,26 @@ class OrderItem(models.Model):
         self.price = self.product.get_effective_price()
         super().save(*args, **kwargs)
 
+class PaymentRequest(models.Model):
+    # Outbox entry: the gateway invoice for an order is created after the order commits
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    order = models.OneToOneField(Order, related_name='payment_request', on_delete=models.CASCADE)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending', db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    payment_url = models.URLField(max_length=500, null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Payment request for Order #{self.order_id} ({self.status})"
+
 class Payment(models.Model):
     order = models.OneToOneField(Order, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
@@ -214,3 +442,23 @@ class Payment(models.Model):
     
 
 
+
+
+class IdempotencyKey(models.Model):
+    # Response of a request made with an Idempotency-Key, replayed on retries.
+    # key_hash / request_hash are sha256 hex digests so stored keys stay small
+    scope = models.CharField(max_length=32)
+    key_hash = models.CharField(max_length=64)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response = models.JSONField(null=True, blank=True)  # None while the request is running
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'key_hash'], name='unique_idempotency_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} key {self.key_hash[:12]}"
@@ -0,0 +1,144 @@
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Coalesce, Now
+
+from .inventory import reserve_stock
+from .models import BasketItem, Order, OrderItem, Product
+
+
+def lock_prices(product_ids):
+    """
+    Read the effective price of every product in one query, locking the rows
+    (where the database supports it) until the surrounding transaction ends.
+
+    :return: Dict mapping product id to its effective price
+    """
+    return dict(
+        Product.objects.select_for_update()
+        .filter(id__in=product_ids)
+        .values_list('id', 'effective_price')
+    )
+
+
+def lines_total(lines, prices):
+    return sum((prices[product_id] * quantity for product_id, quantity in lines.items()), Decimal('0'))
+
+
+def create_order_items(order, lines, prices):
+    # bulk_create skips OrderItem.save, which would re-read every product;
+    # the prices passed in are the snapshot kept on the order
+    return OrderItem.objects.bulk_create([
+        OrderItem(order=order, product_id=product_id, price=prices[product_id], quantity=quantity)
+        for product_id, quantity in lines.items()
+    ])
+
+
+def create_order_from_basket(basket):
+    """
+    Turn a basket into an order in one transaction.
+
+    The basket lines and their current prices are read with a single join,
+    stock for every line is taken with one conditional UPDATE, the order
+    items are written with one bulk_create (prices snapshotted from
+    effective_price) and the basket is emptied with one delete, so the
+    number of round trips does not grow with the basket.
+
+    :param basket: Basket to check out
+    :return: The created Order
+    :raises ValueError: When the basket is empty
+    :raises InsufficientInventory: When any line cannot be served; nothing is written
+    """
+    with transaction.atomic():
+        rows = (
+            BasketItem.objects.filter(basket=basket)
+            .order_by('id')
+            .values_list('product_id', 'quantity', 'product__effective_price')
+        )
+        lines, prices = {}, {}
+        for product_id, quantity, price in rows:
+            lines[product_id] = quantity
+            prices[product_id] = price
+        if not lines:
+            raise ValueError('Basket is empty')
+
+        reserve_stock(lines)
+        order = Order.objects.create(user_id=basket.user_id, total_amount=lines_total(lines, prices))
+        create_order_items(order, lines, prices)
+        BasketItem.objects.filter(basket=basket).delete()
+    return order
+
+
+# transition: preconditions (field: required value), fields it sets and the
+# timestamp it stamps; canceled orders never move
+ORDER_TRANSITIONS = {
+    'pay': {'requires': {'paid': False}, 'sets': {'paid': True, 'payment_status': 'completed'}, 'timestamp': None},
+    'receive': {'requires': {'received': False}, 'sets': {'received': True}, 'timestamp': 'received_at'},
+    'print': {'requires': {'printed': False}, 'sets': {'printed': True}, 'timestamp': None},
+    'package': {'requires': {'packaged': False}, 'sets': {'packaged': True}, 'timestamp': 'packaged_at'},
+    'deliver': {'requires': {'packaged': True, 'delivered': False}, 'sets': {'delivered': True}, 'timestamp': 'delivered_at'},
+}
+BULK_TRANSITION_MAX = 5000
+
+
+def transition_filter(transition):
+    rule = ORDER_TRANSITIONS[transition]
+    return Q(**rule['requires']) & ~Q(payment_status='canceled')
+
+
+def rejection_reason(transition, state):
+    # None when the order's current state allows the transition
+    if state['payment_status'] == 'canceled':
+        return 'Order is canceled'
+    for field, required in ORDER_TRANSITIONS[transition]['requires'].items():
+        if state[field] != required:
+            return f"Order is {'not ' if required else 'already '}{field}"
+    return None
+
+
+def transition_orders(order_ids, transition):
+    """
+    Apply one state transition to many orders with a single UPDATE.
+
+    Only orders whose current state allows the transition are touched, and
+    the matching timestamp is stamped in SQL (kept if already set, like
+    Order.save does).
+
+    :param order_ids: Ids of the orders to move
+    :param transition: One of ORDER_TRANSITIONS
+    :return: One outcome dict per requested id, in request order
+    :raises ValueError: For an unknown transition or too many ids
+    """
+    if transition not in ORDER_TRANSITIONS:
+        raise ValueError(f"Unknown transition '{transition}', expected one of: {', '.join(ORDER_TRANSITIONS)}")
+    order_ids = list(dict.fromkeys(int(order_id) for order_id in order_ids))
+    if len(order_ids) > BULK_TRANSITION_MAX:
+        raise ValueError(f'At most {BULK_TRANSITION_MAX} orders per request')
+
+    rule = ORDER_TRANSITIONS[transition]
+    allowed = transition_filter(transition)
+    changes = dict(rule['sets'])
+    if rule['timestamp']:
+        changes[rule['timestamp']] = Coalesce(F(rule['timestamp']), Now())
+
+    state_fields = ['id', 'payment_status', *{field for rule in ORDER_TRANSITIONS.values() for field in rule['requires']}]
+    with transaction.atomic():
+        states = {
+            state['id']: state
+            for state in Order.objects.select_for_update().filter(id__in=order_ids).values(*state_fields)
+        }
+        eligible = {order_id for order_id, state in states.items() if rejection_reason(transition, state) is None}
+        if eligible:
+            # The rows are locked, the filter is repeated for databases that cannot lock
+            Order.objects.filter(allowed, id__in=eligible).update(**changes)
+
+    outcomes = []
+    for order_id in order_ids:
+        if order_id not in states:
+            outcomes.append({'id': order_id, 'status': 'not_found', 'detail': 'Order not found'})
+        elif order_id in eligible:
+            outcomes.append({'id': order_id, 'status': 'updated'})
+        else:
+            outcomes.append({'id': order_id, 'status': 'rejected', 'detail': rejection_reason(transition, states[order_id])})
+    return outcomes
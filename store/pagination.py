@@ -0,0 +1,19 @@
+from rest_framework.pagination import CursorPagination
+
+
+class ProductCursorPagination(CursorPagination):
+    # Keyset pagination on the unique position column, so every page costs the
+    # same indexed range scan however deep the client scrolls.
+    ordering = 'position'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class OrderHistoryCursorPagination(CursorPagination):
+    # Newest first on (created_at, id); with the (user, created_at) index a
+    # customer's page costs the same however many orders exist
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
@@ -48,7 +48,7 @@ def get_payment_token(amount, order_id, customer_name):
         }
         
         try:
-            response = requests.request(request_type, api_url, data=json.dumps(request_data), headers=headers)
+            response = requests.request(request_type, api_url, data=json.dumps(request_data), headers=headers, timeout=settings.MYFATOORAH_TIMEOUT)
             response_data = response.json()
             print(response_data)
             
@@ -84,7 +84,7 @@ def get_all_payments():
         'Content-Type': 'application/json'
     }
     
-    response = requests.get(url, headers=headers)
+    response = requests.get(url, headers=headers, timeout=settings.MYFATOORAH_TIMEOUT)
     return response.json()
 
 def check_payment_status(invoice_id):
@@ -105,5 +105,5 @@ def check_payment_status(invoice_id):
         "KeyType": "InvoiceId"
     }
     
-    response = requests.post(url, json=data, headers=headers)
+    response = requests.post(url, json=data, headers=headers, timeout=settings.MYFATOORAH_TIMEOUT)
     return response.json()
@@ -0,0 +1,80 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import PaymentRequest
+from .paymentMyFatorah import get_payment_token
+from .workers import submit
+
+logger = logging.getLogger(__name__)
+
+# A request left in 'processing' this long is assumed to belong to a dead worker
+STALE_AFTER = timedelta(minutes=5)
+
+
+def enqueue_payment(order):
+    """
+    Record that the order needs a gateway invoice and hand it to a worker
+    once the surrounding transaction commits.
+
+    Call this inside the transaction that creates the order, so the outbox
+    entry exists exactly when the order does.
+    """
+    payment_request = PaymentRequest.objects.create(order=order)
+    transaction.on_commit(lambda: schedule_payment(payment_request.id))
+    return payment_request
+
+
+def claimable():
+    return Q(status='pending') | Q(status='failed', attempts__lt=settings.PAYMENT_MAX_ATTEMPTS) | Q(
+        status='processing', updated_at__lt=timezone.now() - STALE_AFTER
+    )
+
+
+def process_payment(payment_request_id):
+    """
+    Create the gateway invoice for one outbox entry.
+
+    The entry is claimed with a conditional UPDATE so two workers never call
+    the gateway for the same order, and the gateway call itself runs outside
+    any transaction.
+
+    :return: The payment URL, or None if the entry was not claimed or the call failed
+    """
+    claimed = PaymentRequest.objects.filter(claimable(), id=payment_request_id).update(
+        status='processing', attempts=F('attempts') + 1, updated_at=timezone.now()
+    )
+    if not claimed:
+        return None
+
+    payment_request = PaymentRequest.objects.select_related('order__user').get(id=payment_request_id)
+    order = payment_request.order
+    try:
+        payment_url = get_payment_token(order.total_amount * 100, order.id, order.user.username)
+        error = '' if payment_url else 'The payment gateway did not return an invoice URL'
+    except Exception as e:
+        payment_url, error = None, str(e)
+
+    if payment_url:
+        PaymentRequest.objects.filter(id=payment_request_id).update(status='done', payment_url=payment_url, error='', updated_at=timezone.now())
+    else:
+        logger.error(f"Creating the invoice for order {order.id} failed: {error}")
+        PaymentRequest.objects.filter(id=payment_request_id).update(status='failed', error=error, updated_at=timezone.now())
+    return payment_url
+
+
+def schedule_payment(payment_request_id):
+    # PAYMENT_WORKERS = 0 calls the gateway inline, after the order committed
+    submit(
+        'payment-outbox', settings.PAYMENT_WORKERS,
+        f"Payment request {payment_request_id}", process_payment, payment_request_id,
+    )
+
+
+def pending_payment_ids(limit=None):
+    ids = PaymentRequest.objects.filter(claimable()).order_by('id').values_list('id', flat=True)
+    return list(ids[:limit] if limit else ids)
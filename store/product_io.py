@@ -0,0 +1,246 @@
+import csv
+import io
+import tempfile
+from itertools import islice
+
+from django.db import IntegrityError, transaction
+from openpyxl import Workbook, load_workbook
+
+from .catalog import invalidate_catalog
+from .models import KeyFeature, Product, Sequence
+from .search import index_products
+from .serializers import ProductImportRowSerializer
+from .signals import bulk_catalog_changes
+
+EXPORT_COLUMNS = ['id', 'name', 'description', 'price', 'offer_price', 'inventory_count', 'is_active', 'position', 'key_features']
+UPDATE_FIELDS = ['name', 'description', 'price', 'offer_price', 'inventory_count', 'is_active', 'position']
+KEY_FEATURE_SEPARATOR = '|'
+CHUNK_SIZE = 500
+
+
+def export_rows(chunk_size=CHUNK_SIZE):
+    """
+    Yield the header and one row per product, reading the catalog in chunks.
+    """
+    yield EXPORT_COLUMNS
+    products = Product.objects.order_by('position').prefetch_related('key_features').iterator(chunk_size=chunk_size)
+    for product in products:
+        yield [
+            product.id,
+            product.name,
+            product.description,
+            product.price,
+            product.offer_price if product.offer_price is not None else '',
+            product.inventory_count,
+            product.is_active,
+            product.position,
+            KEY_FEATURE_SEPARATOR.join(feature.feature_text for feature in product.key_features.all()),
+        ]
+
+
+class Echo:
+    # csv.writer only needs an object with write(); hand each line straight back
+    def write(self, value):
+        return value
+
+
+def stream_csv():
+    writer = csv.writer(Echo())
+    for row in export_rows():
+        yield writer.writerow(row)
+
+
+def export_xlsx():
+    """
+    Write the catalog to a temporary XLSX file and return it rewound.
+
+    The workbook is write-only, so rows are flushed to disk as they are added
+    instead of being kept in memory.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('products')
+    for row in export_rows():
+        sheet.append([str(value) if hasattr(value, 'as_tuple') else value for value in row])
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+    return output
+
+
+def read_csv(uploaded_file):
+    text = io.TextIOWrapper(uploaded_file, encoding='utf-8-sig', newline='')
+    reader = csv.reader(text)
+    header = next(reader, None)
+    if header is None:
+        return
+    header = [column.strip() for column in header]
+    for row in reader:
+        yield dict(zip(header, row))
+
+
+def read_xlsx(uploaded_file):
+    workbook = load_workbook(uploaded_file, read_only=True, data_only=True)
+    rows = workbook.active.iter_rows(values_only=True)
+    header = next(rows, None)
+    if header is None:
+        return
+    header = [str(column).strip() if column is not None else '' for column in header]
+    for row in rows:
+        if all(value is None for value in row):
+            continue
+        yield {column: ('' if value is None else value) for column, value in zip(header, row)}
+
+
+def clean_row(row):
+    data = {}
+    for column in EXPORT_COLUMNS:
+        if column not in row:
+            continue
+        value = row[column]
+        if isinstance(value, str):
+            value = value.strip()
+        # Blank cells mean "not given" so partial sheets can update a few columns
+        if value == '' and column not in ('offer_price', 'key_features'):
+            continue
+        data[column] = None if value == '' and column == 'offer_price' else value
+    return data
+
+
+def import_products(uploaded_file, file_type, chunk_size=CHUNK_SIZE):
+    """
+    Create or update products (and their key features) from a CSV or XLSX file.
+
+    Rows are read one at a time and written in chunks with bulk_create /
+    bulk_update, each chunk in its own transaction. Rows with an id update
+    that product, rows without one create a new product.
+
+    :param uploaded_file: File object of the upload
+    :param file_type: 'csv' or 'xlsx'
+    :param chunk_size: Rows validated and written per transaction
+    :return: Dict with created / updated counts and per-row errors
+    """
+    reader = read_xlsx if file_type == 'xlsx' else read_csv
+    rows = enumerate(reader(uploaded_file), start=2)  # Row 1 is the header
+    report = {'created': 0, 'updated': 0, 'errors': []}
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        import_chunk(chunk, report)
+
+    invalidate_catalog()
+    return report
+
+
+def position_conflicts(claims):
+    """
+    Find rows whose position is claimed twice in a chunk or held by another product.
+
+    :param claims: List of (row number, product id or None, new position)
+    :return: Dict mapping row number to an error message
+    """
+    errors, claimed = {}, {}
+    for row_number, _, position in claims:
+        if position in claimed:
+            errors[row_number] = f'Position {position} is also used by row {claimed[position]}.'
+        else:
+            claimed[position] = row_number
+
+    # Products moving away in this chunk free their old positions (as in bulk_reorder)
+    moving = [product_id for row_number, product_id, _ in claims if product_id and row_number not in errors]
+    taken = dict(
+        Product.objects.filter(position__in=claimed.keys())
+        .exclude(id__in=moving)
+        .values_list('position', 'id')
+    )
+    for row_number, _, position in claims:
+        if row_number not in errors and position in taken:
+            errors[row_number] = f'Position {position} is already used by product {taken[position]}.'
+    return errors
+
+
+def import_chunk(chunk, report):
+    valid_rows = []
+    for row_number, row in chunk:
+        serializer = ProductImportRowSerializer(data=clean_row(row))
+        if serializer.is_valid():
+            valid_rows.append((row_number, serializer.validated_data))
+        else:
+            report['errors'].append({'row': row_number, 'errors': serializer.errors})
+
+    existing = Product.objects.in_bulk([data['id'] for _, data in valid_rows if data.get('id')])
+    candidates, claims = [], []
+    for row_number, data in valid_rows:
+        product_id = data.pop('id', None)
+        feature_texts = data.pop('key_features', None)
+        if feature_texts is not None:
+            feature_texts = [text.strip() for text in feature_texts.split(KEY_FEATURE_SEPARATOR) if text.strip()]
+        if product_id:
+            product = existing.get(product_id)
+            if product is None:
+                report['errors'].append({'row': row_number, 'errors': {'id': ['Product not found.']}})
+                continue
+            moves = 'position' in data and data['position'] != product.position
+        else:
+            if not data.get('name') or data.get('price') is None:
+                report['errors'].append({'row': row_number, 'errors': {'name': ['name and price are required for new products.']}})
+                continue
+            moves = 'position' in data
+        if moves and data['position'] is not None:
+            claims.append((row_number, product_id, data['position']))
+        candidates.append((row_number, product_id, data, feature_texts, moves))
+
+    conflicts = position_conflicts(claims) if claims else {}
+    to_create, to_update, features, moved = [], [], [], []
+    for row_number, product_id, data, feature_texts, moves in candidates:
+        if row_number in conflicts:
+            report['errors'].append({'row': row_number, 'errors': {'position': [conflicts[row_number]]}})
+            continue
+        if product_id:
+            product = existing[product_id]
+            if moves:
+                moved.append(product.id)
+            for field, value in data.items():
+                setattr(product, field, value)
+            to_update.append(product)
+        else:
+            product = Product(**data)
+            to_create.append(product)
+        if feature_texts is not None:
+            features.append((product, feature_texts))
+
+    try:
+        with transaction.atomic(), bulk_catalog_changes():
+            if moved:
+                # Clear the old positions first so swaps never trip the unique
+                # index, which SQLite checks row by row (as in bulk_reorder)
+                Product.objects.filter(id__in=moved).update(position=None)
+            unpositioned = [product for product in to_create if product.position is None]
+            if unpositioned:
+                # Reserve a block of positions in one counter update
+                first = Product.next_position(count=len(unpositioned))
+                for offset, product in enumerate(unpositioned):
+                    product.position = first + offset
+            Product.objects.bulk_create(to_create)
+            if to_update:
+                Product.objects.bulk_update(to_update, UPDATE_FIELDS)
+            explicit_positions = [product.position for product in to_create + to_update if product.position]
+            if explicit_positions:
+                Sequence.ensure_at_least(Product.POSITION_SEQUENCE, max(explicit_positions))
+
+            if features:
+                KeyFeature.objects.filter(product__in=[product for product, _ in features]).delete()
+                KeyFeature.objects.bulk_create([
+                    KeyFeature(product=product, feature_text=text)
+                    for product, feature_texts in features
+                    for text in feature_texts
+                ])
+            index_products([product.id for product in to_create + to_update])
+    except IntegrityError as e:
+        first_row, last_row = chunk[0][0], chunk[-1][0]
+        report['errors'].append({'rows': [first_row, last_row], 'errors': {'non_field_errors': [str(e)]}})
+        return
+
+    report['created'] += len(to_create)
+    report['updated'] += len(to_update)
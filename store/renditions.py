@@ -0,0 +1,116 @@
+import hashlib
+import io
+import logging
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from .catalog import invalidate_catalog
+from .workers import submit
+
+logger = logging.getLogger(__name__)
+
+# name: (max width, max height, Pillow format, file extension)
+RENDITIONS = {
+    'thumbnail': (150, 150, 'JPEG', 'jpg'),
+    'card': (400, 400, 'JPEG', 'jpg'),
+    'detail': (1200, 1200, 'JPEG', 'jpg'),
+    'webp': (1200, 1200, 'WEBP', 'webp'),
+}
+RENDITIONS_DIR = 'products/renditions'
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+
+
+def rendition_name(product_id, image_name, rendition):
+    # The product id and a hash of the full source name keep two products
+    # (or C2.png and C2.jpg) from ever sharing a rendition file
+    stem = os.path.splitext(os.path.basename(image_name))[0]
+    source_hash = hashlib.sha1(image_name.encode('utf-8')).hexdigest()[:8]
+    extension = RENDITIONS[rendition][3]
+    return f'{RENDITIONS_DIR}/{product_id}_{stem}_{source_hash}_{rendition}.{extension}'
+
+
+def needs_renditions(product):
+    return bool(product.image) and (product.image_renditions or {}).get('source') != product.image.name
+
+
+def encode(image, image_format):
+    output = io.BytesIO()
+    if image_format == 'JPEG':
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    else:
+        image.save(output, image_format, quality=WEBP_QUALITY, method=4)
+    return output.getvalue()
+
+
+def render_image(source):
+    """
+    Resize one original image into every rendition.
+
+    :param source: Readable file of the original image
+    :return: Dict mapping rendition name to encoded bytes
+    """
+    largest = max((width, height) for width, height, _, _ in RENDITIONS.values())
+    with Image.open(source) as original:
+        # Let the JPEG decoder downscale while decoding instead of
+        # materialising the full camera resolution
+        original.draft('RGB', largest)
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ('RGB', 'RGBA'):
+            has_alpha = 'A' in original.getbands() or 'transparency' in original.info
+            original = original.convert('RGBA' if has_alpha else 'RGB')
+
+        encoded = {}
+        for rendition, (width, height, image_format, _) in RENDITIONS.items():
+            image = original.copy()
+            image.thumbnail((width, height), Image.LANCZOS)
+            encoded[rendition] = encode(image, image_format)
+    return encoded
+
+
+def generate_renditions(product_id):
+    """
+    Build and store the renditions of a product image, then record them on the product.
+    """
+    from .models import Product
+
+    product = Product.objects.filter(pk=product_id).only('id', 'image', 'image_renditions').first()
+    if product is None or not needs_renditions(product):
+        return None
+
+    source_name = product.image.name
+    with default_storage.open(source_name, 'rb') as source:
+        encoded = render_image(source)
+
+    previous = product.image_renditions or {}
+    renditions = {'source': source_name}
+    for rendition, content in encoded.items():
+        name = rendition_name(product_id, source_name, rendition)
+        if default_storage.exists(name):
+            # Only this product's renditions of this very image can live here
+            default_storage.delete(name)
+        renditions[rendition] = default_storage.save(name, ContentFile(content))
+
+    # Only record the renditions if the image was not replaced meanwhile
+    updated = Product.objects.filter(pk=product_id, image=source_name).update(image_renditions=renditions)
+    if updated:
+        invalidate_catalog()
+        # Remove the files of this product's previous image, never anyone else's
+        for rendition, name in previous.items():
+            if rendition in RENDITIONS and name not in renditions.values() and name.startswith(f'{RENDITIONS_DIR}/{product_id}_'):
+                default_storage.delete(name)
+    return renditions
+
+
+def schedule_renditions(product_id):
+    # IMAGE_RENDITION_WORKERS = 0 renders inline, which tests rely on
+    submit(
+        'image-renditions', settings.IMAGE_RENDITION_WORKERS,
+        f"Generating renditions for product {product_id}", generate_renditions, product_id,
+    )
@@ -0,0 +1,92 @@
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+from .models import Product
+
+FTS_TABLE = 'store_product_fts'
+SEARCH_MAX_RESULTS = 100
+
+# Column weights for bm25(): name, description, key features
+FTS_WEIGHTS = (10.0, 1.0, 3.0)
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def fts_available():
+    return connection.vendor == 'sqlite'
+
+
+def index_products(product_ids):
+    """
+    Refresh the full-text index rows of the given products.
+
+    Rows of products that no longer exist are dropped, so this is also used
+    after deletes.
+    """
+    product_ids = [int(product_id) for product_id in product_ids]
+    if not product_ids or not fts_available():
+        return
+    placeholders = ', '.join(['%s'] * len(product_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})', product_ids)
+        cursor.execute(
+            f'''
+            INSERT INTO {FTS_TABLE} (rowid, name, description, features)
+            SELECT p.id, p.name, p.description,
+                   COALESCE((SELECT group_concat(k.feature_text, ' ')
+                             FROM store_keyfeature k WHERE k.product_id = p.id), '')
+            FROM store_product p
+            WHERE p.id IN ({placeholders})
+            ''',
+            product_ids,
+        )
+
+
+def build_match_expression(query):
+    # Every word must match, and the last one may be a prefix of a longer word
+    # so results show up while the user is still typing.
+    tokens = TOKEN_RE.findall(query or '')
+    if not tokens:
+        return None
+    terms = ['"%s"' % token for token in tokens]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def search_product_ids(query, limit=SEARCH_MAX_RESULTS, queryset=None):
+    """
+    Return the ids of products matching the query, best match first.
+
+    :param query: Free text typed by the user
+    :param limit: Maximum number of ids to return
+    :param queryset: Products allowed in the results (e.g. in stock and active);
+        applied inside the search query, before the limit
+    :return: List of product ids ordered by relevance
+    """
+    expression = build_match_expression(query)
+    if expression is None:
+        return []
+    if queryset is None:
+        queryset = Product.objects.all()
+
+    if not fts_available():
+        # Without FTS5 fall back to a plain LIKE scan
+        filters = Q()
+        for token in TOKEN_RE.findall(query):
+            filters &= (
+                Q(name__icontains=token)
+                | Q(description__icontains=token)
+                | Q(key_features__feature_text__icontains=token)
+            )
+        return list(queryset.filter(filters).order_by().values_list('id', flat=True).distinct()[:limit])
+
+    allowed_sql, allowed_params = queryset.order_by().values('id').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s AND rowid IN ({allowed_sql}) '
+            f'ORDER BY bm25({FTS_TABLE}, %s, %s, %s) LIMIT %s',
+            [expression, *allowed_params, *FTS_WEIGHTS, limit],
+        )
+        return [row[0] for row in cursor.fetchall()]
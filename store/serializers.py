@@ -1,20 +1,75 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
 from .models import Address, City, KeyFeature, Payment, Product, Basket, BasketItem, Order, OrderItem, Coupon
-from django.db.models import OuterRef, Subquery
+from django.core.files.storage import default_storage
+from .renditions import RENDITIONS
+
+
+class SparseFieldsMixin:
+    """
+    Lets GET requests trim the output with ?fields=a,b or ?omit=a,b.
+
+    Unselected fields are dropped before serialization, so their queries and
+    SerializerMethodField calls never run.
+    """
+    # Keys added in to_representation rather than declared as fields
+    extra_fields = ()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.selected_fields = self.get_selected_fields()
+        if self.selected_fields is not None:
+            for name in list(self.fields):
+                if name not in self.selected_fields:
+                    self.fields.pop(name)
+
+    def get_selected_fields(self):
+        request = self.context.get('request')
+        # Writes need every field for validation
+        if request is None or request.method not in ('GET', 'HEAD'):
+            return None
+        fields = split_field_names(request.query_params.get('fields'))
+        omit = split_field_names(request.query_params.get('omit'))
+        if not fields and not omit:
+            return None
+        available = set(self.fields) | set(self.extra_fields)
+        selected = available & fields if fields else available
+        return selected - omit
+
+    def includes_field(self, name):
+        return self.selected_fields is None or name in self.selected_fields
+
+
+def split_field_names(value):
+    return {name.strip() for name in (value or '').split(',') if name.strip()}
+
+
+def field_requested(request, name):
+    """
+    Whether `name` survives the ?fields= / ?omit= selection of the request,
+    so views can skip prefetches for fields that will not be rendered.
+    """
+    if request is None or request.method not in ('GET', 'HEAD'):
+        return True
+    fields = split_field_names(request.query_params.get('fields'))
+    omit = split_field_names(request.query_params.get('omit'))
+    return (not fields or name in fields) and name not in omit
 
 
 class KeyFeatureSerializer(serializers.ModelSerializer):
     class Meta:
         model = KeyFeature
         fields = ['id', 'feature_text','product']
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     effective_price = serializers.SerializerMethodField()
     is_alive = serializers.SerializerMethodField()
+    renditions = serializers.SerializerMethodField()
+
+    extra_fields = ('key_features',)
 
     class Meta:
         model = Product
-        fields = '__all__'
+        exclude = ['image_renditions']
 
     def get_effective_price(self, obj):
         return obj.get_effective_price()
@@ -22,12 +77,46 @@ class ProductSerializer(serializers.ModelSerializer):
         if obj.inventory_count > 0 :
             return True
         return False
+    def get_renditions(self, obj):
+        # Until the background resize finishes every rendition falls back to the original
+        if not obj.image:
+            return None
+        stored = obj.image_renditions if (obj.image_renditions or {}).get('source') == obj.image.name else {}
+        request = self.context.get('request')
+        renditions = {}
+        for rendition in RENDITIONS:
+            url = default_storage.url(stored[rendition]) if rendition in stored else obj.image.url
+            renditions[rendition] = request.build_absolute_uri(url) if request else url
+        return renditions
     def to_representation(self, instance):
         data = super().to_representation(instance)
         # Example: You can add more fields or manipulate existing ones here
-        data['key_features'] = KeyFeatureSerializer(instance.key_features.all(), many=True).data
+        if self.includes_field('key_features'):
+            data['key_features'] = KeyFeatureSerializer(instance.key_features.all(), many=True).data
         return data
 
+class ProductPositionSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    position = serializers.IntegerField(min_value=1)
+
+class ProductImportRowSerializer(serializers.Serializer):
+    id = serializers.IntegerField(min_value=1, required=False)
+    name = serializers.CharField(max_length=255, required=False)
+    description = serializers.CharField(required=False, allow_blank=True)
+    price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0, required=False)
+    offer_price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0, required=False, allow_null=True)
+    inventory_count = serializers.IntegerField(min_value=0, required=False)
+    is_active = serializers.BooleanField(required=False)
+    position = serializers.IntegerField(min_value=1, required=False)
+    key_features = serializers.CharField(required=False, allow_blank=True)
+
+class ProductBulkUpdateSerializer(serializers.Serializer):
+    id = serializers.IntegerField(min_value=1)
+    price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0, required=False)
+    offer_price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0, required=False, allow_null=True)
+    inventory_count = serializers.IntegerField(min_value=0, required=False)
+    is_active = serializers.BooleanField(required=False)
+
 class BasketItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = BasketItem
@@ -35,10 +124,18 @@ class BasketItemSerializer(serializers.ModelSerializer):
 
 class BasketSerializer(serializers.ModelSerializer):
     items = BasketItemSerializer(many=True, read_only=True)
+    total_items = serializers.SerializerMethodField()
+    total_price = serializers.SerializerMethodField()
 
     class Meta:
         model = Basket
         fields = '__all__'
+
+    def get_total_items(self, obj):
+        return obj.total_items()
+
+    def get_total_price(self, obj):
+        return obj.total_price()
 class CitySerializer(serializers.ModelSerializer):
     class Meta:
         model = City
@@ -104,7 +201,7 @@ class PaymentSerializer(serializers.ModelSerializer):
             'transaction_date'
         ]
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     items = OrderItemSerializer(many=True, read_only=True)
     last_payment = serializers.SerializerMethodField()
     all_payments = serializers.SerializerMethodField()
@@ -117,22 +214,19 @@ class OrderSerializer(serializers.ModelSerializer):
     def get_client_name(self, obj):
         return obj.user.username
 
+    def completed_payment(self, obj):
+        # Payment is one-to-one with the order; views join it with select_related('payment')
+        payment = getattr(obj, 'payment', None)
+        return payment if payment is not None and payment.status == 'completed' else None
+
     def get_last_payment(self, obj):
-        # Subquery to fetch the latest completed payment
-        latest_payment_subquery = Payment.objects.filter(
-            order=OuterRef('pk'), status='completed'
-        ).order_by('-created_at').values('id')[:1]
-        
-        latest_payment = Payment.objects.filter(id__in=Subquery(latest_payment_subquery))
-        payment = latest_payment.first() if latest_payment.exists() else None
-        
+        payment = self.completed_payment(obj)
         return PaymentSerializer(payment).data if payment else None
 
     def get_all_payments(self, obj):
-        # Fetch all completed payments
-        payments = Payment.objects.filter(order=obj, status='completed')
-        return PaymentSerializer(payments, many=True).data if payments.exists() else []
-        return PaymentSerializer(payments, many=True).data if payments.exists() else []
+        payment = self.completed_payment(obj)
+        return [PaymentSerializer(payment).data] if payment else []
+
 class CreateOrderSerializer(serializers.ModelSerializer):
     class Meta:
         model = Order
@@ -0,0 +1,57 @@
+import threading
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .catalog import invalidate_catalog
+from .models import KeyFeature, Product
+from .renditions import needs_renditions, schedule_renditions
+from .search import index_products
+
+_state = threading.local()
+
+
+@contextmanager
+def bulk_catalog_changes():
+    """
+    Skip the per-row catalog handlers below while a bulk write runs.
+    The caller is responsible for reindexing and invalidating once at the end.
+    """
+    previous = getattr(_state, 'muted', False)
+    _state.muted = True
+    try:
+        yield
+    finally:
+        _state.muted = previous
+
+
+def is_muted():
+    return getattr(_state, 'muted', False)
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=KeyFeature)
+def catalog_changed(sender, **kwargs):
+    if not is_muted():
+        invalidate_catalog()
+
+
+@receiver([post_save, post_delete], sender=Product)
+def product_search_index_changed(sender, instance, **kwargs):
+    if not is_muted():
+        index_products([instance.pk])
+
+
+@receiver([post_save, post_delete], sender=KeyFeature)
+def key_feature_search_index_changed(sender, instance, **kwargs):
+    if not is_muted():
+        index_products([instance.product_id])
+
+
+@receiver(post_save, sender=Product)
+def product_image_changed(sender, instance, **kwargs):
+    if needs_renditions(instance):
+        product_id = instance.pk
+        transaction.on_commit(lambda: schedule_renditions(product_id))
@@ -0,0 +1,1358 @@
+import csv
+import io
+import tempfile
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+from django.contrib import admin
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from openpyxl import load_workbook
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_jwt.utils import jwt_encode_handler
+from api.models import User
+from api.views import jwt_payload_handler
+from rest_framework import status
+from .inventory import InsufficientInventory, merge_lines, reserve_stock
+from .admin import OrderAdmin
+from .catalog import CATALOG_VERSION_KEY, CATALOG_VERSION_SEQUENCE
+from .idempotency import begin_request
+from .models import Address, Basket, BasketItem, City, IdempotencyKey, KeyFeature, Order, OrderItem, Payment, PaymentRequest, Product, Sequence
+from .orders import create_order_from_basket
+from .renditions import RENDITIONS
+from .workers import submit
+
+
+def create_product(name='Product', price='100.00', inventory_count=10, features=2, **kwargs):
+    product = Product.objects.create(
+        name=name,
+        description=f'{name} description',
+        price=Decimal(price),
+        inventory_count=inventory_count,
+        **kwargs
+    )
+    for index in range(features):
+        KeyFeature.objects.create(product=product, feature_text=f'{name} feature {index}')
+    return product
+
+
+class ProductCatalogQueryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def count_list_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries)
+
+    def test_catalog_query_count_does_not_grow_with_catalog_size(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            create_product(name='First')
+        small_catalog_queries = self.count_list_queries('/api/products/')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for index in range(10):
+                create_product(name=f'Product {index}')
+        large_catalog_queries = self.count_list_queries('/api/products/')
+
+        self.assertEqual(small_catalog_queries, large_catalog_queries)
+
+    def test_manager_list_query_count_does_not_grow_with_catalog_size(self):
+        create_product(name='First')
+        small_catalog_queries = self.count_list_queries('/api/products-manager/')
+
+        for index in range(10):
+            create_product(name=f'Product {index}')
+        large_catalog_queries = self.count_list_queries('/api/products-manager/')
+
+        self.assertEqual(small_catalog_queries, large_catalog_queries)
+
+    def test_catalog_includes_key_features(self):
+        create_product(name='Serum', features=3)
+        response = self.client.get('/api/products/')
+        self.assertEqual(len(response.json()['results'][0]['key_features']), 3)
+
+
+class ProductCatalogSnapshotTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.product = create_product(name='Serum')
+
+    def test_catalog_response_has_strong_etag(self):
+        response = self.client.get('/api/products/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertEqual(response.json()['results'][0]['name'], 'Serum')
+
+    def test_matching_if_none_match_returns_304_without_queries(self):
+        etag = self.client.get('/api/products/')['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_repeat_request_is_served_from_snapshot(self):
+        first = self.client.get('/api/products/')
+        with self.assertNumQueries(0):
+            second = self.client.get('/api/products/')
+        self.assertEqual(first.content, second.content)
+
+    def test_unknown_query_parameters_share_the_snapshot(self):
+        first = self.client.get('/api/products/', {'in_stock': 'true', 'page_size': 5})
+        with self.assertNumQueries(0):
+            second = self.client.get('/api/products/', {'utm_source': 'mail', 'page_size': 5, 'in_stock': 'true'})
+        self.assertEqual(first['ETag'], second['ETag'])
+        self.assertNotEqual(self.client.get('/api/products/', {'in_stock': 'false'})['ETag'], first['ETag'])
+
+    def test_product_change_invalidates_snapshot(self):
+        etag = self.client.get('/api/products/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = 'Night Serum'
+            self.product.save()
+        response = self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['results'][0]['name'], 'Night Serum')
+
+    def test_key_feature_change_invalidates_snapshot(self):
+        etag = self.client.get('/api/products/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            KeyFeature.objects.create(product=self.product, feature_text='Vegan')
+        response = self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()['results'][0]['key_features']), 3)
+
+    def test_invalidation_bumps_the_version_once_after_commit(self):
+        version = Sequence.objects.filter(name=CATALOG_VERSION_SEQUENCE).values_list('value', flat=True).first() or 0
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.product.name = 'Night Serum'
+            self.product.save()
+            self.assertEqual(Sequence.objects.filter(name=CATALOG_VERSION_SEQUENCE).values_list('value', flat=True).first() or 0, version)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(Sequence.objects.get(name=CATALOG_VERSION_SEQUENCE).value, version + 1)
+
+    def test_bump_from_another_worker_is_seen_once_cached_version_expires(self):
+        etag = self.client.get('/api/products/')['ETag']
+        # Another process changes the catalog: only the database is shared with it
+        Product.objects.filter(id=self.product.id).update(name='Day Serum')
+        Sequence.next_value(CATALOG_VERSION_SEQUENCE)
+        self.assertEqual(self.client.get('/api/products/')['ETag'], etag)
+
+        cache.delete(CATALOG_VERSION_KEY)  # CATALOG_VERSION_TIMEOUT passed
+        response = self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['results'][0]['name'], 'Day Serum')
+
+
+class ProductCursorPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        for index in range(5):
+            create_product(name=f'Product {index}', features=0)
+
+    def test_pages_follow_position_order_with_stable_cursors(self):
+        response = self.client.get('/api/products/', {'page_size': 2})
+        data = response.json()
+        self.assertIsNone(data['previous'])
+        names = [product['name'] for product in data['results']]
+
+        while data['next']:
+            data = self.client.get(data['next']).json()
+            self.assertIsNotNone(data['previous'])
+            names += [product['name'] for product in data['results']]
+
+        self.assertEqual(names, [f'Product {index}' for index in range(5)])
+
+    def test_page_query_count_does_not_depend_on_depth(self):
+        first_page = self.client.get('/api/products-manager/', {'page_size': 1}).json()
+        with CaptureQueriesContext(connection) as first_context:
+            self.client.get('/api/products-manager/', {'page_size': 1})
+
+        data = first_page
+        for _ in range(3):
+            data = self.client.get(data['next']).json()
+        with CaptureQueriesContext(connection) as deep_context:
+            self.client.get(data['next'])
+
+        self.assertEqual(len(first_context.captured_queries), len(deep_context.captured_queries))
+        self.assertNotIn('OFFSET', deep_context.captured_queries[0]['sql'].upper())
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.serum = create_product(name='Vitamin C Serum', features=0)
+        self.cream = create_product(name='Night Cream', features=0)
+        KeyFeature.objects.create(product=self.cream, feature_text='Contains vitamin E')
+
+    def search(self, query):
+        response = self.client.get('/api/products/search/', {'q': query})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [product['name'] for product in response.json()['results']]
+
+    def test_name_matches_rank_above_feature_matches(self):
+        self.assertEqual(self.search('vitamin'), ['Vitamin C Serum', 'Night Cream'])
+
+    def test_prefix_matching(self):
+        self.assertEqual(self.search('ser'), ['Vitamin C Serum'])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.serum.name = 'Hyaluronic Serum'
+        self.serum.save()
+        self.assertEqual(self.search('hyaluronic'), ['Hyaluronic Serum'])
+
+        self.cream.key_features.all().delete()
+        self.assertEqual(self.search('contains'), [])
+
+        self.serum.delete()
+        self.assertEqual(self.search('serum'), [])
+
+    def test_blank_query_returns_nothing(self):
+        self.assertEqual(self.search('  '), [])
+
+    def test_limit_applies_after_storefront_filters(self):
+        for index in range(5):
+            create_product(name=f'Rose Oil {index}', inventory_count=0, features=0)
+        create_product(name='Rose Water', features=0)
+        response = self.client.get('/api/products/search/', {'q': 'rose', 'limit': 3})
+        self.assertEqual([product['name'] for product in response.json()['results']], ['Rose Water'])
+
+    def test_limit_must_be_positive(self):
+        for limit in (0, -1):
+            response = self.client.get('/api/products/search/', {'q': 'serum', 'limit': limit})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ProductPositionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def test_positions_are_allocated_without_aggregate(self):
+        first = create_product(name='First', features=0)
+        with CaptureQueriesContext(connection) as context:
+            second = create_product(name='Second', features=0)
+        self.assertEqual(second.position, first.position + 1)
+        self.assertFalse(any('MAX(' in query['sql'].upper() for query in context.captured_queries))
+
+    def test_counter_skips_explicit_positions(self):
+        create_product(name='Pinned', features=0, position=50)
+        self.assertEqual(create_product(name='Next', features=0).position, 51)
+
+    def test_save_without_position_change_leaves_counter_alone(self):
+        product = Product.objects.get(id=create_product(name='Stable', features=0).id)
+        with CaptureQueriesContext(connection) as context:
+            product.name = 'Renamed'
+            product.save()
+        self.assertFalse(any(Product.POSITION_SEQUENCE in query['sql'] for query in context.captured_queries))
+
+        product.position = 80
+        product.save()
+        self.assertEqual(create_product(name='Next', features=0).position, 81)
+
+    def test_bulk_reorder_swaps_positions(self):
+        first = create_product(name='First', features=0)
+        second = create_product(name='Second', features=0)
+        response = self.client.post('/api/products-manager/reorder/', {'positions': [
+            {'id': first.id, 'position': second.position},
+            {'id': second.id, 'position': first.position},
+        ]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['moved'], 2)
+        self.assertEqual(list(Product.objects.values_list('name', flat=True)), ['Second', 'First'])
+
+    def test_bulk_reorder_rejects_positions_held_by_other_products(self):
+        first = create_product(name='First', features=0)
+        second = create_product(name='Second', features=0)
+        response = self.client.post('/api/products-manager/reorder/', {'positions': [
+            {'id': first.id, 'position': second.position},
+        ]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        first.refresh_from_db()
+        self.assertEqual(first.position, 1)
+
+    def test_bulk_reorder_rejects_a_list_body(self):
+        response = self.client.post('/api/products-manager/reorder/', [{'id': 1, 'position': 2}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ProductPositionConcurrencyTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_creates_get_distinct_positions(self):
+        errors = []
+
+        def worker(index):
+            try:
+                create_product(name=f'Product {index}', features=0)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        positions = list(Product.objects.values_list('position', flat=True))
+        self.assertEqual(sorted(positions), list(range(1, 9)))
+
+
+class ProductImportExportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.product = create_product(name='Serum', features=2)
+
+    def upload(self, name, content):
+        return self.client.post('/api/products-manager/import/', {'file': SimpleUploadedFile(name, content)}, format='multipart')
+
+    def test_csv_export_streams_every_product(self):
+        create_product(name='Cream', features=0)
+        response = self.client.get('/api/products-manager/export/')
+        self.assertTrue(response.streaming)
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(rows[0][0], 'id')
+        self.assertEqual([row[1] for row in rows[1:]], ['Serum', 'Cream'])
+        self.assertEqual(rows[1][-1], 'Serum feature 0|Serum feature 1')
+
+    def test_csv_import_creates_updates_and_reports_errors(self):
+        content = (
+            'id,name,description,price,inventory_count,key_features\n'
+            f'{self.product.id},Serum,,120.00,5,Vegan|Cruelty free\n'
+            ',Cream,Night cream,80.00,3,\n'
+            ',Broken,,not-a-price,1,\n'
+        ).encode()
+        response = self.upload('products.csv', content)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        report = response.json()
+        self.assertEqual((report['created'], report['updated']), (1, 1))
+        self.assertEqual(report['errors'][0]['row'], 4)
+
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.price, Decimal('120.00'))
+        self.assertEqual(sorted(self.product.key_features.values_list('feature_text', flat=True)), ['Cruelty free', 'Vegan'])
+        cream = Product.objects.get(name='Cream')
+        self.assertEqual(cream.position, self.product.position + 1)
+
+    def test_csv_import_swaps_positions(self):
+        cream = create_product(name='Cream', features=0)
+        first, second = self.product.position, cream.position
+        content = (
+            'id,position\n'
+            f'{self.product.id},{second}\n'
+            f'{cream.id},{first}\n'
+        ).encode()
+        report = self.upload('products.csv', content).json()
+        self.assertEqual((report['updated'], report['errors']), (2, []))
+        self.assertEqual(Product.objects.get(id=self.product.id).position, second)
+        self.assertEqual(Product.objects.get(id=cream.id).position, first)
+
+    def test_csv_import_reports_position_conflicts_per_row(self):
+        content = (
+            'name,price,position\n'
+            f'Taken,10.00,{self.product.position}\n'
+            'Cream,20.00,90\n'
+            'Mask,30.00,90\n'
+            'Toner,40.00,\n'
+        ).encode()
+        report = self.upload('products.csv', content).json()
+        self.assertEqual(report['created'], 2)
+        self.assertEqual([(error['row'], list(error['errors'])) for error in report['errors']], [(2, ['position']), (4, ['position'])])
+        self.assertEqual(Product.objects.get(name='Cream').position, 90)
+        self.assertFalse(Product.objects.filter(name__in=['Taken', 'Mask']).exists())
+
+    def test_xlsx_round_trip(self):
+        response = self.client.get('/api/products-manager/export/', {'file_type': 'xlsx'})
+        workbook = load_workbook(io.BytesIO(b''.join(response.streaming_content)))
+        sheet = workbook.active
+        sheet.cell(row=2, column=6, value=42)  # inventory_count
+
+        output = io.BytesIO()
+        workbook.save(output)
+        response = self.upload('products.xlsx', output.getvalue())
+        self.assertEqual(response.json()['updated'], 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.inventory_count, 42)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMAGE_RENDITION_WORKERS=0)
+class ProductImageRenditionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def make_image(self, size=(2400, 1800), name='camera.jpg', image_format='JPEG'):
+        output = io.BytesIO()
+        Image.new('RGB', size, 'red').save(output, image_format)
+        return SimpleUploadedFile(name, output.getvalue(), content_type=f'image/{image_format.lower()}')
+
+    def test_upload_generates_resized_renditions(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = create_product(name='Serum', features=0, image=self.make_image())
+
+        product.refresh_from_db()
+        self.assertEqual(product.image_renditions['source'], product.image.name)
+        for rendition, (width, height, image_format, _) in RENDITIONS.items():
+            with default_storage.open(product.image_renditions[rendition]) as stored, Image.open(stored) as image:
+                self.assertLessEqual(image.width, width)
+                self.assertLessEqual(image.height, height)
+                self.assertEqual(image.format, image_format)
+
+        data = self.client.get(f'/api/products/{product.id}/').json()
+        self.assertTrue(data['renditions']['thumbnail'].endswith('_thumbnail.jpg'))
+        self.assertTrue(data['renditions']['webp'].endswith('_webp.webp'))
+
+    def test_products_with_same_image_stem_keep_their_own_renditions(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = create_product(name='Serum', features=0, image=self.make_image(name='C2.png', image_format='PNG'))
+        with self.captureOnCommitCallbacks(execute=True):
+            second = create_product(name='Cream', features=0, image=self.make_image(name='C2.jpg'))
+        first.refresh_from_db()
+        second.refresh_from_db()
+        for rendition in RENDITIONS:
+            self.assertNotEqual(first.image_renditions[rendition], second.image_renditions[rendition])
+            self.assertTrue(default_storage.exists(first.image_renditions[rendition]))
+            self.assertTrue(default_storage.exists(second.image_renditions[rendition]))
+
+    def test_renditions_fall_back_to_original_until_generated(self):
+        product = create_product(name='Serum', features=0, image=self.make_image())
+        data = self.client.get(f'/api/products/{product.id}/').json()
+        self.assertEqual(data['renditions']['card'], data['image'])
+
+
+class SparseFieldsetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='buyer', password='M@123456789')
+        self.client.credentials(HTTP_AUTHORIZATION=f'JWT {jwt_encode_handler(jwt_payload_handler(self.user))}')
+        self.product = create_product(name='Serum')
+        self.order = Order.objects.create(user=self.user, total_amount=Decimal('100.00'))
+        OrderItem.objects.create(order=self.order, product=self.product, price=self.product.price, quantity=1)
+
+    def test_product_fields_selects_keys(self):
+        response = self.client.get('/api/products-manager/', {'fields': 'id,name'})
+        self.assertEqual(set(response.json()['results'][0]), {'id', 'name'})
+
+    def test_product_omit_skips_key_feature_queries(self):
+        with CaptureQueriesContext(connection) as full:
+            self.client.get('/api/products-manager/')
+        with CaptureQueriesContext(connection) as trimmed:
+            response = self.client.get('/api/products-manager/', {'omit': 'key_features'})
+        self.assertNotIn('key_features', response.json()['results'][0])
+        self.assertLess(len(trimmed.captured_queries), len(full.captured_queries))
+
+    def test_order_fields_skip_method_field_queries(self):
+        with CaptureQueriesContext(connection) as full:
+            self.client.get('/api/orders/')
+        with CaptureQueriesContext(connection) as trimmed:
+            response = self.client.get('/api/orders/', {'fields': 'id,paid,payment_status'})
+        self.assertEqual(response.json(), [{'id': self.order.id, 'paid': False, 'payment_status': 'pending'}])
+        self.assertLess(len(trimmed.captured_queries), len(full.captured_queries))
+
+    def test_writes_ignore_field_selection(self):
+        response = self.client.patch(f'/api/products-manager/{self.product.id}/?fields=id', {'inventory_count': 3}, format='json')
+        self.assertEqual(response.json()['inventory_count'], 3)
+
+
+class InventoryReservationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.serum = create_product(name='Serum', inventory_count=5, features=0)
+        self.cream = create_product(name='Cream', inventory_count=1, features=0)
+
+    def test_reserves_all_lines_in_one_update(self):
+        with CaptureQueriesContext(connection) as context:
+            reserve_stock({self.serum.id: 2, self.cream.id: 1})
+        updates = [query for query in context.captured_queries if query['sql'].startswith('UPDATE "store_product"')]
+        self.assertEqual(len(updates), 1)
+        self.serum.refresh_from_db()
+        self.cream.refresh_from_db()
+        self.assertEqual((self.serum.inventory_count, self.cream.inventory_count), (3, 0))
+
+    def test_reports_failed_lines_and_reserves_nothing(self):
+        with self.assertRaises(InsufficientInventory) as raised:
+            reserve_stock({self.serum.id: 2, self.cream.id: 3, 999: 1})
+        self.assertEqual(raised.exception.failures, [
+            {'product_id': self.cream.id, 'requested': 3, 'available': 1},
+            {'product_id': 999, 'requested': 1, 'available': None},
+        ])
+        self.serum.refresh_from_db()
+        self.assertEqual(self.serum.inventory_count, 5)
+
+    def test_merge_lines_adds_up_repeated_products(self):
+        self.assertEqual(dict(merge_lines([1, '2', 1], [1, 2, '3'])), {1: 4, 2: 2})
+
+    def test_order_create_returns_failed_lines(self):
+        user = User.objects.create_user(username='buyer', password='M@123456789')
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'JWT {jwt_encode_handler(jwt_payload_handler(user))}')
+        response = client.post('/api/orders/', {
+            'products': [self.serum.id, self.cream.id],
+            'quantities': [1, 2],
+            'shippingAddress': {'id': 1, 'city': {'shipment_fee': '10.00'}},
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()['failed_lines'][0]['product_id'], self.cream.id)
+        self.assertFalse(Order.objects.exists())
+
+
+class InventoryConcurrencyTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_checkouts_never_oversell(self):
+        product = create_product(name='Serum', inventory_count=10, features=0)
+        other = create_product(name='Cream', inventory_count=100, features=0)
+        results = []
+
+        def checkout():
+            try:
+                reserve_stock({product.id: 1, other.id: 1})
+                results.append(True)
+            except InsufficientInventory:
+                results.append(False)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout) for _ in range(25)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        product.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(results.count(True), 10)
+        self.assertEqual(product.inventory_count, 0)
+        self.assertEqual(other.inventory_count, 90)
+
+
+class ProductPriceFilterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        create_product(name='Cheap', price='50.00', features=0)
+        create_product(name='Discounted', price='500.00', offer_price=Decimal('80.00'), features=0)
+        create_product(name='Expensive', price='300.00', features=0)
+
+    def names(self, params):
+        response = self.client.get('/api/products/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [product['name'] for product in response.json()['results']]
+
+    def test_effective_price_follows_offer_price(self):
+        product = Product.objects.get(name='Discounted')
+        self.assertEqual(product.effective_price, Decimal('80.00'))
+        product.offer_price = None
+        product.save()
+        product.refresh_from_db()
+        self.assertEqual(product.effective_price, Decimal('500.00'))
+
+    def test_price_range_uses_effective_price(self):
+        self.assertEqual(self.names({'min_price': '60', 'max_price': '400'}), ['Discounted', 'Expensive'])
+
+    def test_ordering_by_effective_price(self):
+        self.assertEqual(self.names({'ordering': '-effective_price'}), ['Expensive', 'Discounted', 'Cheap'])
+        self.assertEqual(self.names({'ordering': 'effective_price', 'page_size': 2}), ['Cheap', 'Discounted'])
+
+    def test_invalid_price_is_rejected(self):
+        response = self.client.get('/api/products/', {'min_price': 'cheap'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ProductFacetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        with self.captureOnCommitCallbacks(execute=True):
+            create_product(name='Cheap', price='50.00', features=0)
+            create_product(name='Offer', price='500.00', offer_price=Decimal('80.00'), features=0)
+            create_product(name='Sold out', price='300.00', inventory_count=0, features=0)
+            create_product(name='Hidden', price='1500.00', is_active=False, features=0)
+
+    def names(self, params=None):
+        response = self.client.get('/api/products/', params or {})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [product['name'] for product in response.json()['results']]
+
+    def test_storefront_defaults_to_active_in_stock_products(self):
+        self.assertEqual(self.names(), ['Cheap', 'Offer'])
+        self.assertEqual(self.names({'in_stock': 'any', 'is_active': 'any'}), ['Cheap', 'Offer', 'Sold out', 'Hidden'])
+
+    def test_facet_filters(self):
+        self.assertEqual(self.names({'on_offer': 'true'}), ['Offer'])
+        self.assertEqual(self.names({'in_stock': 'false'}), ['Sold out'])
+        self.assertEqual(self.names({'is_active': 'any', 'price_bucket': '0-100,1000+'}), ['Cheap', 'Offer', 'Hidden'])
+
+    def test_facet_counts_in_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/products/facets/')
+        counts = response.json()
+        # Each facet is counted under the other facets' selection
+        self.assertEqual(counts['in_stock'], {'true': 2, 'false': 1})
+        self.assertEqual(counts['is_active'], {'true': 2, 'false': 1})
+        self.assertEqual(counts['on_offer'], {'true': 1, 'false': 1})
+        self.assertEqual(counts['price_bucket']['0-100'], 2)
+        self.assertEqual(counts['price_bucket']['1000+'], 0)
+
+    def test_unknown_facet_value_is_rejected(self):
+        response = self.client.get('/api/products/', {'on_offer': 'maybe'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ProductBatchLookupTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.products = [create_product(name=f'Product {index}') for index in range(5)]
+        self.sold_out = create_product(name='Sold out', inventory_count=0)
+
+    def test_returns_products_in_requested_order_and_reports_missing(self):
+        ids = [self.sold_out.id, self.products[2].id, 999, self.products[0].id]
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/products/batch/', {'ids': ','.join(map(str, ids))})
+        data = response.json()
+        self.assertEqual([product['id'] for product in data['results']], [self.sold_out.id, self.products[2].id, self.products[0].id])
+        self.assertEqual(data['missing'], [999])
+        self.assertEqual(len(data['results'][1]['key_features']), 2)
+        self.assertIn('effective_price', data['results'][1])
+
+    def test_rejects_malformed_ids(self):
+        response = self.client.get('/api/products/batch/', {'ids': '1,abc'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ProductBulkUpdateTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.products = [create_product(name=f'Product {index}', features=0) for index in range(30)]
+
+    def test_applies_patches_in_constant_queries_with_per_row_results(self):
+        rows = [{'id': product.id, 'inventory_count': 100 + index} for index, product in enumerate(self.products)]
+        rows.append({'id': self.products[0].id, 'price': '1.00'})
+        rows.append({'id': 999, 'is_active': False})
+        rows.append({'id': self.products[1].id, 'price': '-5'})
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post('/api/products-manager/bulk-update/', {'products': rows}, format='json')
+        self.assertLess(len(context.captured_queries), 10)
+
+        data = response.json()
+        self.assertEqual(data['updated'], 30)
+        self.assertEqual([result['status'] for result in data['results'][-3:]], ['error', 'error', 'error'])
+        self.assertIn('price', data['results'][-1]['errors'])
+        self.assertEqual(Product.objects.get(id=self.products[5].id).inventory_count, 105)
+
+    def test_offer_price_can_be_cleared(self):
+        product = self.products[0]
+        Product.objects.filter(id=product.id).update(offer_price=Decimal('10.00'))
+        self.client.post('/api/products-manager/bulk-update/', {'products': [{'id': product.id, 'offer_price': None}]}, format='json')
+        product.refresh_from_db()
+        self.assertIsNone(product.offer_price)
+        self.assertEqual(product.effective_price, product.price)
+
+    def test_list_body_is_rejected(self):
+        response = self.client.post('/api/products-manager/bulk-update/', [{'id': self.products[0].id, 'price': '1.00'}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class BasketUpsertTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='buyer', password='M@123456789')
+        self.basket = Basket.objects.create(user=self.user)
+        self.serum = create_product(name='Serum', inventory_count=10, features=0)
+        self.cream = create_product(name='Cream', inventory_count=1, features=0)
+
+    def upsert(self, items):
+        return self.client.post(f'/api/baskets/{self.basket.id}/upsert-items/', {'items': items}, format='json')
+
+    def test_adds_and_increments_lines_in_constant_queries(self):
+        self.upsert([{'product_id': self.serum.id, 'quantity': 2}])
+        with CaptureQueriesContext(connection) as context:
+            response = self.upsert([
+                {'product_id': self.serum.id, 'quantity': 3},
+                {'product_id': self.cream.id},
+            ])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertLessEqual(len(context.captured_queries), 7)
+        quantities = dict(self.basket.items.values_list('product_id', 'quantity'))
+        self.assertEqual(quantities, {self.serum.id: 5, self.cream.id: 1})
+
+    def test_reports_failed_lines(self):
+        response = self.upsert([
+            {'product_id': self.serum.id, 'quantity': 1},
+            {'product_id': self.cream.id, 'quantity': 5},
+            {'product_id': 999},
+        ])
+        data = response.json()
+        self.assertEqual(data['added'], [{'product_id': self.serum.id, 'quantity': 1}])
+        self.assertEqual([line['product_id'] for line in data['failed']], [self.cream.id, 999])
+
+    def test_add_to_basket_merges_into_one_line(self):
+        for _ in range(2):
+            self.client.post(f'/api/baskets/{self.basket.id}/add-to-basket/', {'product_id': self.serum.id, 'quantity': 2}, format='json')
+        self.assertEqual(list(self.basket.items.values_list('quantity', flat=True)), [4])
+
+    def test_add_to_basket_rejects_invalid_quantities(self):
+        for quantity in (-3, 0, 'abc'):
+            response = self.client.post(f'/api/baskets/{self.basket.id}/add-to-basket/', {'product_id': self.serum.id, 'quantity': quantity}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, quantity)
+        self.assertFalse(self.basket.items.exists())
+        with self.assertRaises(ValueError):
+            self.basket.add_items({self.serum.id: -1})
+
+
+class BasketUpsertConcurrencyTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_adds_merge(self):
+        user = User.objects.create_user(username='buyer', password='M@123456789')
+        basket = Basket.objects.create(user=user)
+        product = create_product(name='Serum', features=0)
+
+        def add():
+            try:
+                basket.add_items({product.id: 1})
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=add) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(list(BasketItem.objects.values_list('quantity', flat=True)), [10])
+
+
+class BasketTotalsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='buyer', password='M@123456789')
+        self.basket = Basket.objects.create(user=self.user)
+        self.serum = create_product(name='Serum', price='100.00', offer_price=Decimal('80.00'), features=0)
+        self.cream = create_product(name='Cream', price='50.00', features=0)
+        self.basket.add_items({self.serum.id: 2, self.cream.id: 1})
+
+    def test_totals_use_offer_price_in_one_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.basket.totals(), {'total_items': 2, 'total_price': Decimal('210.00')})
+
+    def test_item_and_price_changes_invalidate_totals(self):
+        self.basket.total_price()
+        BasketItem.objects.filter(product=self.cream).get().delete()
+        self.assertEqual(self.basket.total_price(), Decimal('160.00'))
+
+        self.serum.offer_price = None
+        self.serum.save()
+        self.assertEqual(self.basket.total_price(), Decimal('200.00'))
+
+        self.client.post('/api/products-manager/bulk-update/', {'products': [{'id': self.serum.id, 'price': '10.00'}]}, format='json')
+        self.assertEqual(self.basket.total_price(), Decimal('20.00'))
+
+    def test_basket_list_query_count_is_constant(self):
+        def list_queries():
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get('/api/baskets/')
+            return response, len(context.captured_queries)
+
+        response, few = list_queries()
+        self.assertEqual(response.json()[0]['total_price'], 210.0)
+        for index in range(5):
+            basket = Basket.objects.create(user=self.user)
+            basket.add_items({self.serum.id: index + 1})
+        response, many = list_queries()
+        self.assertEqual(few, many)
+        self.assertEqual(len(response.json()), 6)
+
+
+class GuestBasketTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='guest', password='M@123456789')
+        self.serum = create_product(name='Serum', price='100.00', features=0)
+        self.cream = create_product(name='Cream', price='50.00', inventory_count=1, features=0)
+        self.token = self.client.post('/api/guest-baskets/').json()['token']
+
+    def test_guest_items_stay_out_of_the_database(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(f'/api/guest-baskets/{self.token}/items/', {'items': [
+                {'product_id': self.serum.id, 'quantity': 2},
+                {'product_id': self.cream.id, 'quantity': 5},
+                {'product_id': 999999},
+            ]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(context.captured_queries), 1)
+        self.assertTrue(context.captured_queries[0]['sql'].startswith('SELECT'))
+        self.assertEqual(response.json()['items'], [{'product_id': self.serum.id, 'quantity': 2}])
+        self.assertEqual(len(response.json()['failed']), 2)
+        self.assertFalse(Basket.objects.exists())
+
+        response = self.client.get(f'/api/guest-baskets/{self.token}/')
+        self.assertEqual(response.json()['items'], [{'product_id': self.serum.id, 'quantity': 2}])
+
+    def test_unknown_token_is_not_found(self):
+        response = self.client.post('/api/guest-baskets/missing/items/', {'items': [{'product_id': self.serum.id}]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_login_merges_guest_basket_into_existing_basket(self):
+        basket = Basket.objects.create(user=self.user)
+        basket.add_items({self.serum.id: 1})
+        self.client.post(f'/api/guest-baskets/{self.token}/items/', {'items': [
+            {'product_id': self.serum.id, 'quantity': 2},
+            {'product_id': self.cream.id},
+        ]}, format='json')
+
+        response = self.client.post('/api/login/', {'username': 'guest', 'password': 'M@123456789', 'cart_token': self.token}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['basket_id'], basket.id)
+        quantities = dict(BasketItem.objects.filter(basket=basket).values_list('product_id', 'quantity'))
+        self.assertEqual(quantities, {self.serum.id: 3, self.cream.id: 1})
+        self.assertEqual(self.client.get(f'/api/guest-baskets/{self.token}/').status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_merge_action_creates_basket(self):
+        self.client.post(f'/api/guest-baskets/{self.token}/items/', {'items': [{'product_id': self.serum.id}]}, format='json')
+        self.client.credentials(HTTP_AUTHORIZATION=f'JWT {jwt_encode_handler(jwt_payload_handler(self.user))}')
+        response = self.client.post(f'/api/guest-baskets/{self.token}/merge/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['total_items'], 1)
+        self.assertEqual(Basket.objects.get(user=self.user).items.get().quantity, 1)
+
+    def test_guest_basket_survives_catalog_traffic(self):
+        self.client.post(f'/api/guest-baskets/{self.token}/items/', {'items': [{'product_id': self.serum.id}]}, format='json')
+        # More distinct catalog snapshots than the default cache keeps
+        for min_price in range(400):
+            self.client.get(f'/api/products/?min_price={min_price}')
+        response = self.client.get(f'/api/guest-baskets/{self.token}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['items'], [{'product_id': self.serum.id, 'quantity': 1}])
+
+
+class BasketCheckoutTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='checkout', password='M@123456789')
+        self.basket = Basket.objects.create(user=self.user)
+
+    def fill_basket(self, count):
+        products = [create_product(name=f'Item {index}', price='20.00', offer_price=Decimal('15.00'), features=0) for index in range(count)]
+        self.basket.add_items({product.id: 2 for product in products})
+        return products
+
+    def test_create_order_snapshots_prices_and_takes_stock(self):
+        products = self.fill_basket(2)
+        response = self.client.post(f'/api/baskets/{self.basket.id}/create-order/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        order = Order.objects.get()
+        self.assertEqual(order.total_amount, Decimal('60.00'))
+        self.assertEqual(list(order.items.values_list('price', 'quantity')), [(Decimal('15.00'), 2)] * 2)
+        self.assertEqual(set(Product.objects.values_list('inventory_count', flat=True)), {8})
+        self.assertFalse(BasketItem.objects.exists())
+
+        # Later price changes leave the order untouched
+        products[0].offer_price = None
+        products[0].save()
+        self.assertEqual(order.items.get(product=products[0]).price, Decimal('15.00'))
+
+    def test_round_trips_do_not_grow_with_basket_size(self):
+        def checkout_queries(count):
+            self.fill_basket(count)
+            with CaptureQueriesContext(connection) as context:
+                create_order_from_basket(self.basket)
+            return len(context.captured_queries)
+
+        self.assertEqual(checkout_queries(2), checkout_queries(12))
+
+    def test_shortage_writes_nothing(self):
+        products = self.fill_basket(2)
+        Product.objects.filter(id=products[1].id).update(inventory_count=1)
+        response = self.client.post(f'/api/baskets/{self.basket.id}/create-order/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()['failed_lines'], [{'product_id': products[1].id, 'requested': 2, 'available': 1}])
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(BasketItem.objects.count(), 2)
+        self.assertEqual(Product.objects.get(id=products[0].id).inventory_count, 10)
+
+    def test_empty_basket_is_rejected(self):
+        response = self.client.post(f'/api/baskets/{self.basket.id}/create-order/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()['detail'], 'Basket is empty')
+
+
+class AbandonedBasketPurgeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='idle', password='M@123456789')
+        self.product = create_product(name='Serum', price='100.00', features=0)
+        self.old = []
+        for _ in range(5):
+            basket = Basket.objects.create(user=self.user)
+            basket.add_items({self.product.id: 1})
+            self.old.append(basket.id)
+        Basket.objects.filter(id__in=self.old).update(updated_at=timezone.now() - timedelta(days=45))
+        self.fresh = Basket.objects.create(user=self.user)
+        self.fresh.add_items({self.product.id: 2})
+
+    def purge(self, *args):
+        output = io.StringIO()
+        call_command('purge_abandoned_baskets', *args, stdout=output)
+        return output.getvalue()
+
+    def test_dry_run_only_reports(self):
+        output = self.purge('--dry-run')
+        self.assertIn('Would delete 5 baskets and 5 basket items', output)
+        self.assertEqual(Basket.objects.count(), 6)
+
+    def test_deletes_idle_baskets_in_batches(self):
+        with CaptureQueriesContext(connection) as context:
+            output = self.purge('--batch-size', '2')
+        self.assertIn('Deleted 5 baskets and 5 basket items', output)
+        self.assertEqual(list(Basket.objects.values_list('id', flat=True)), [self.fresh.id])
+        self.assertEqual(BasketItem.objects.count(), 1)
+        deletes = [query for query in context.captured_queries if query['sql'].startswith('DELETE FROM "store_basket"')]
+        self.assertEqual(len(deletes), 3)
+
+    def test_retention_is_configurable(self):
+        self.assertIn('Deleted 0 baskets', self.purge('--days', '60'))
+        self.assertEqual(Basket.objects.count(), 6)
+
+
+@override_settings(PAYMENT_WORKERS=0)
+@mock.patch('store.payment_outbox.get_payment_token', return_value='https://pay.example/invoice')
+class OrderCreateTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='orders', password='M@123456789')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'JWT {jwt_encode_handler(jwt_payload_handler(self.user))}')
+        city = City.objects.create(name='Cairo', shipment_fee=Decimal('10.00'))
+        self.address = Address.objects.create(user=self.user, address_line='1 Nile St', city=city, state='Cairo', country='EG', postal_code='11511')
+
+    def place(self, products, quantities):
+        return self.client.post('/api/orders/', {
+            'products': [product.id for product in products],
+            'quantities': quantities,
+            'shippingAddress': {'id': self.address.id, 'city': {'shipment_fee': '10.00'}},
+        }, format='json')
+
+    def test_order_is_written_once_with_final_total(self, payment):
+        serum = create_product(name='Serum', price='100.00', offer_price=Decimal('80.00'), features=0)
+        cream = create_product(name='Cream', price='50.00', features=0)
+        with CaptureQueriesContext(connection) as context:
+            response = self.place([serum, cream, serum], [1, 2, 1])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        order = Order.objects.get()
+        # (160 + 100) plus 1% tax on the subtotal and shipping fee
+        self.assertEqual(order.total_amount, Decimal('262.70'))
+        self.assertEqual(order.shipping_address, self.address)
+        self.assertEqual(dict(order.items.values_list('product_id', 'price')), {serum.id: Decimal('80.00'), cream.id: Decimal('50.00')})
+        self.assertEqual(dict(order.items.values_list('product_id', 'quantity')), {serum.id: 2, cream.id: 2})
+        sql = [query['sql'] for query in context.captured_queries]
+        self.assertEqual(len([query for query in sql if query.startswith('INSERT INTO "store_order"')]), 1)
+        self.assertFalse([query for query in sql if query.startswith('UPDATE "store_order"')])
+
+    def test_round_trips_do_not_grow_with_line_count(self, payment):
+        def order_queries(count):
+            products = [create_product(name=f'Item {index}', price='10.00', features=0) for index in range(count)]
+            with CaptureQueriesContext(connection) as context:
+                response = self.place(products, [1] * count)
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            return len(context.captured_queries)
+
+        self.assertEqual(order_queries(2), order_queries(15))
+
+    def test_invalid_quantity_is_rejected(self, payment):
+        serum = create_product(name='Serum', price='100.00', features=0)
+        response = self.place([serum], [0])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Order.objects.exists())
+        payment.assert_not_called()
+
+
+@override_settings(PAYMENT_WORKERS=0, PAYMENT_MAX_ATTEMPTS=2)
+@mock.patch('store.payment_outbox.get_payment_token', return_value='https://pay.example/invoice')
+class PaymentOutboxTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='payer', password='M@123456789')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'JWT {jwt_encode_handler(jwt_payload_handler(self.user))}')
+        city = City.objects.create(name='Giza', shipment_fee=Decimal('0.00'))
+        self.address = Address.objects.create(user=self.user, address_line='2 Pyramid Rd', city=city, state='Giza', country='EG', postal_code='12511')
+        self.serum = create_product(name='Serum', price='100.00', features=0)
+
+    def place(self):
+        return self.client.post('/api/orders/', {
+            'products': [self.serum.id],
+            'quantities': [1],
+            'shippingAddress': {'id': self.address.id},
+        }, format='json')
+
+    def test_gateway_is_called_only_after_commit(self, payment):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.place()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()['payment_status'], 'pending')
+        self.assertIsNone(response.json()['url_payment'])
+        payment.assert_not_called()
+
+        for callback in callbacks:
+            callback()
+        order_id = response.json()['order_id']
+        payment.assert_called_once_with(Decimal('10100.00'), order_id, 'payer')
+        response = self.client.get(f'/api/orders/{order_id}/payment-link/')
+        self.assertEqual(response.json(), {'order_id': order_id, 'payment_status': 'done', 'url_payment': 'https://pay.example/invoice'})
+
+    def test_failed_requests_are_retried_until_max_attempts(self, payment):
+        payment.return_value = None
+        with self.captureOnCommitCallbacks(execute=True):
+            order_id = self.place().json()['order_id']
+        payment_request = PaymentRequest.objects.get(order_id=order_id)
+        self.assertEqual((payment_request.status, payment_request.attempts), ('failed', 1))
+
+        payment.return_value = 'https://pay.example/retry'
+        output = io.StringIO()
+        call_command('process_payment_outbox', stdout=output)
+        self.assertIn('Created 1 invoices', output.getvalue())
+        payment_request.refresh_from_db()
+        self.assertEqual((payment_request.status, payment_request.attempts, payment_request.payment_url), ('done', 2, 'https://pay.example/retry'))
+
+        # Finished requests are never sent again
+        call_command('process_payment_outbox', stdout=io.StringIO())
+        self.assertEqual(payment.call_count, 2)
+
+    def test_rolled_back_order_leaves_no_outbox_entry(self, payment):
+        Product.objects.filter(id=self.serum.id).update(inventory_count=0)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.place()
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(PaymentRequest.objects.exists())
+        payment.assert_not_called()
+
+
+class OrderListQueryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='lister', password='M@123456789')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'JWT {jwt_encode_handler(jwt_payload_handler(self.user))}')
+        self.products = [create_product(name=f'Item {index}', price='10.00', features=0) for index in range(3)]
+
+    def add_orders(self, count):
+        for _ in range(count):
+            order = Order.objects.create(user=self.user, total_amount=Decimal('30.00'))
+            OrderItem.objects.bulk_create([OrderItem(order=order, product=product, price=product.price) for product in self.products])
+            Payment.objects.create(order=order, amount=order.total_amount, status='completed')
+
+    def list_queries(self, url='/api/orders/'):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, len(context.captured_queries)
+
+    def test_list_query_count_is_constant(self):
+        self.add_orders(2)
+        _, few = self.list_queries()
+        self.add_orders(6)
+        response, many = self.list_queries()
+        self.assertEqual(few, many)
+        self.assertLessEqual(many, 4)
+
+        order = response.json()[0]
+        self.assertEqual(order['client_name'], 'lister')
+        self.assertEqual([item['product_name'] for item in order['items']], ['Item 0', 'Item 1', 'Item 2'])
+        self.assertEqual(order['last_payment']['status'], 'completed')
+        self.assertEqual(len(order['all_payments']), 1)
+
+    def test_orders_without_completed_payment(self):
+        order = Order.objects.create(user=self.user, total_amount=Decimal('10.00'))
+        Payment.objects.create(order=Order.objects.create(user=self.user, total_amount=Decimal('10.00')), amount=Decimal('10.00'))
+        response, _ = self.list_queries(f'/api/orders/{order.id}/')
+        self.assertIsNone(response.json()['last_payment'])
+        self.assertEqual(response.json()['all_payments'], [])
+        response, _ = self.list_queries()
+        self.assertEqual([order['all_payments'] for order in response.json()], [[], []])
+
+    def test_sparse_fields_skip_prefetches(self):
+        self.add_orders(2)
+        response, queries = self.list_queries('/api/orders/?fields=id,total_amount')
+        self.assertEqual(set(response.json()[0]), {'id', 'total_amount'})
+        self.assertLessEqual(queries, 2)
+
+
+class OrderFilterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='backoffice', password='M@123456789')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'JWT {jwt_encode_handler(jwt_payload_handler(self.user))}')
+        now = timezone.now()
+        self.open = Order.objects.create(user=self.user, total_amount=Decimal('10.00'), paid=True)
+        self.packed = Order.objects.create(user=self.user, total_amount=Decimal('10.00'), paid=True, packaged=True, payment_status='completed')
+        self.old = Order.objects.create(user=self.user, total_amount=Decimal('10.00'), delivered=True, payment_status='canceled')
+        Order.objects.filter(id=self.old.id).update(created_at=now - timedelta(days=40))
+
+    def order_ids(self, query):
+        response = self.client.get(f'/api/orders/?fields=id&{query}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        return sorted(order['id'] for order in response.json())
+
+    def test_status_and_date_filters(self):
+        self.assertEqual(self.order_ids('paid=true&packaged=false'), [self.open.id])
+        self.assertEqual(self.order_ids('payment_status=canceled'), [self.old.id])
+        self.assertEqual(self.order_ids('payment_status=completed,canceled&packaged=true'), [self.packed.id])
+        self.assertEqual(self.order_ids('delivered=false'), [self.open.id, self.packed.id])
+        since = (timezone.now() - timedelta(days=7)).date().isoformat()
+        self.assertEqual(self.order_ids(f'created_after={since}'), [self.open.id, self.packed.id])
+        self.assertEqual(self.order_ids(f'created_before={since}'), [self.old.id])
+        self.assertEqual(self.order_ids(f'created_before={timezone.localdate().isoformat()}&packaged=any'), [self.open.id, self.packed.id, self.old.id])
+
+    def test_invalid_filters_are_rejected(self):
+        for query in ('paid=maybe', 'payment_status=lost', 'created_after=yesterday'):
+            response = self.client.get(f'/api/orders/?{query}')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, query)
+
+    def test_back_office_queries_use_indexes(self):
+        since = timezone.now() - timedelta(days=7)
+        plans = {
+            'order_status_created_idx': Order.objects.filter(payment_status='pending', created_at__gte=since),
+            'order_created_idx': Order.objects.filter(created_at__gte=since),
+            'order_unpackaged_idx': Order.objects.filter(paid=True, packaged=False),
+            'order_undelivered_idx': Order.objects.filter(delivered=False).order_by('created_at'),
+        }
+        for index, queryset in plans.items():
+            self.assertIn(index, queryset.explain(), index)
+
+
+class MyOrdersTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='customer', password='M@123456789')
+        other = User.objects.create_user(username='someone', password='M@123456789')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'JWT {jwt_encode_handler(jwt_payload_handler(self.user))}')
+        now = timezone.now()
+        Order.objects.bulk_create([Order(user=other, total_amount=Decimal('5.00')) for _ in range(5)])
+        self.orders = Order.objects.bulk_create([Order(user=self.user, total_amount=Decimal('10.00')) for _ in range(25)])
+        for index, order in enumerate(self.orders):
+            Order.objects.filter(id=order.id).update(created_at=now - timedelta(hours=index))
+
+    def test_pages_through_own_orders_newest_first(self):
+        seen, url, queries = [], '/api/orders/mine/?page_size=10', []
+        while url:
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            queries.append(len(context.captured_queries))
+            seen += [order['id'] for order in response.json()['results']]
+            url = response.json()['next']
+        self.assertEqual(seen, [order.id for order in self.orders])
+        self.assertEqual(queries[0], queries[1])
+
+    def test_history_uses_user_created_index(self):
+        plan = Order.objects.filter(user=self.user).order_by('-created_at', '-id')[:10].explain()
+        self.assertIn('order_user_created_idx', plan)
+
+    def test_requires_token(self):
+        response = APIClient().get('/api/orders/mine/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class OrderTransitionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='fulfilment', password='M@123456789')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'JWT {jwt_encode_handler(jwt_payload_handler(self.user))}')
+        self.orders = Order.objects.bulk_create([Order(user=self.user, total_amount=Decimal('10.00')) for _ in range(3)])
+
+    def transition(self, transition, ids):
+        return self.client.post('/api/orders/transitions/', {'transition': transition, 'ids': ids}, format='json')
+
+    def test_applies_transition_in_one_update_with_per_order_outcomes(self):
+        packed, fresh, canceled = self.orders
+        Order.objects.filter(id=packed.id).update(packaged=True)
+        Order.objects.filter(id=canceled.id).update(payment_status='canceled')
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.transition('deliver', [packed.id, fresh.id, canceled.id, 999999])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['updated'], 1)
+        self.assertEqual(response.json()['results'], [
+            {'id': packed.id, 'status': 'updated'},
+            {'id': fresh.id, 'status': 'rejected', 'detail': 'Order is not packaged'},
+            {'id': canceled.id, 'status': 'rejected', 'detail': 'Order is canceled'},
+            {'id': 999999, 'status': 'not_found', 'detail': 'Order not found'},
+        ])
+        updates = [query for query in context.captured_queries if query['sql'].startswith('UPDATE "store_order"')]
+        self.assertEqual(len(updates), 1)
+
+        packed.refresh_from_db()
+        self.assertTrue(packed.delivered)
+        self.assertIsNotNone(packed.delivered_at)
+        self.assertEqual(Order.objects.filter(delivered=True).count(), 1)
+
+    def test_repeated_transition_is_rejected_and_keeps_timestamp(self):
+        ids = [order.id for order in self.orders]
+        self.transition('package', ids)
+        stamped = dict(Order.objects.values_list('id', 'packaged_at'))
+        response = self.transition('package', ids)
+        self.assertEqual({result['status'] for result in response.json()['results']}, {'rejected'})
+        self.assertEqual(dict(Order.objects.values_list('id', 'packaged_at')), stamped)
+
+    def test_pay_sets_payment_status(self):
+        self.transition('pay', [self.orders[0].id])
+        self.assertEqual(Order.objects.filter(paid=True, payment_status='completed').count(), 1)
+
+    def test_unknown_transition_is_rejected(self):
+        response = self.transition('teleport', [self.orders[0].id])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_admin_action_transitions_more_orders_than_one_request_allows(self):
+        order_admin = OrderAdmin(Order, admin.site)
+        with mock.patch('store.admin.BULK_TRANSITION_MAX', 2), mock.patch.object(order_admin, 'message_user') as message_user:
+            order_admin.mark_as_paid(RequestFactory().post('/admin/'), Order.objects.all())
+        self.assertEqual(Order.objects.filter(paid=True).count(), 3)
+        message_user.assert_called_once_with(mock.ANY, '3 of 3 orders updated')
+
+
+@override_settings(PAYMENT_WORKERS=0)
+@mock.patch('store.payment_outbox.get_payment_token', return_value='https://pay.example/invoice')
+class IdempotencyKeyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='retrier', password='M@123456789')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'JWT {jwt_encode_handler(jwt_payload_handler(self.user))}')
+        city = City.objects.create(name='Alexandria', shipment_fee=Decimal('0.00'))
+        self.address = Address.objects.create(user=self.user, address_line='3 Corniche', city=city, state='Alex', country='EG', postal_code='21500')
+        self.serum = create_product(name='Serum', price='100.00', inventory_count=5, features=0)
+
+    def place(self, key, quantity=1):
+        return self.client.post('/api/orders/', {
+            'products': [self.serum.id],
+            'quantities': [quantity],
+            'shippingAddress': {'id': self.address.id},
+        }, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_stored_response(self, payment):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.place('checkout-1')
+        with self.captureOnCommitCallbacks(execute=True):
+            retry = self.place('checkout-1')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(Product.objects.get(id=self.serum.id).inventory_count, 4)
+        payment.assert_called_once()
+
+        self.place('checkout-2')
+        self.assertEqual(Order.objects.count(), 2)
+
+    def test_key_reused_with_other_payload_is_rejected(self, payment):
+        self.place('checkout-1')
+        response = self.place('checkout-1', quantity=2)
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_failed_request_releases_key(self, payment):
+        response = self.place('checkout-1', quantity=50)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        Product.objects.filter(id=self.serum.id).update(inventory_count=100)
+        response = self.place('checkout-1', quantity=50)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_dead_request_lease_can_be_taken_over(self, payment):
+        # A worker that died after claiming the key leaves a short lease behind
+        payload = {'products': [self.serum.id], 'quantities': [1], 'shippingAddress': {'id': self.address.id}}
+        record = begin_request('order-create', 'checkout-1', self.user.id, payload)
+        self.assertLessEqual(record.expires_at, timezone.now() + timedelta(minutes=5))
+        self.assertEqual(self.place('checkout-1').status_code, status.HTTP_409_CONFLICT)
+
+        IdempotencyKey.objects.update(expires_at=timezone.now())
+        self.assertEqual(self.place('checkout-1').status_code, status.HTTP_201_CREATED)
+        record = IdempotencyKey.objects.get()
+        self.assertGreater(record.expires_at, timezone.now() + timedelta(hours=1))
+
+    def test_expired_keys_are_reclaimed_and_purged(self, payment):
+        self.place('checkout-1')
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.place('checkout-1').status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Order.objects.count(), 2)
+
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        output = io.StringIO()
+        call_command('purge_idempotency_keys', stdout=output)
+        self.assertIn('Deleted 1 expired idempotency keys', output.getvalue())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_repeated_payment_callback_is_processed_once(self, payment):
+        order = Order.objects.create(user=self.user, total_amount=Decimal('10.00'))
+        url = f'/api/Orders/payment/status/?paymentId=pay-1&id=tx-1&order_id={order.id}'
+        with mock.patch('store.views.MyFatoorahCallbackView.fetch_payment_details', autospec=True, side_effect=lambda *args: {
+            'IsSuccess': True,
+            'Data': {'InvoiceId': 1, 'TransactionId': 'tx-1', 'InvoiceStatus': 'Paid', 'InvoiceValue': Decimal('10.00')},
+        }) as fetch:
+            first = self.client.get(url)
+            retry = self.client.get(url)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(retry.json(), first.json())
+        fetch.assert_called_once()
+        order.refresh_from_db()
+        self.assertTrue(order.paid)
+
+
+class WorkerPoolTests(TestCase):
+    def test_jobs_run_on_the_named_pool_and_failures_are_logged(self):
+        done = threading.Event()
+        names = []
+
+        def job(value):
+            names.append(threading.current_thread().name)
+            done.set()
+            raise ValueError(value)
+
+        with self.assertLogs('store.workers', level='ERROR') as logs:
+            submit('test-pool', 1, 'Test job', job, 'boom')
+            self.assertTrue(done.wait(5))
+            # The failure is logged after the job returns on the worker thread
+            for _ in range(50):
+                if logs.records:
+                    break
+                threading.Event().wait(0.1)
+        self.assertTrue(names[0].startswith('test-pool'))
+        self.assertIn('Test job failed: boom', logs.output[0])
+
+    def test_zero_workers_runs_inline(self):
+        calls = []
+        submit('test-inline', 0, 'Inline job', calls.append, 1)
+        self.assertEqual(calls, [1])
@@ -1,12 +1,13 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
-from .views import  AddressViewSet, CheckoutViewSet, CityViewSet, KeyFeatureViewSet, MyFatoorahCallbackView, MyFatoorahWebhookViewSet, OrderStatisticsViewSet, PaymentResponseViewSet, PaymentViewSet, ProductViewManagerSet, ProductViewSet, BasketViewSet, OrderViewSet, OrderItemViewSet, CouponViewSet, StatisticsChartsDataViewSet
+from .views import  AddressViewSet, CheckoutViewSet, CityViewSet, KeyFeatureViewSet, MyFatoorahCallbackView, MyFatoorahWebhookViewSet, OrderStatisticsViewSet, PaymentResponseViewSet, PaymentViewSet, ProductViewManagerSet, ProductViewSet, BasketViewSet, OrderViewSet, OrderItemViewSet, CouponViewSet, GuestBasketViewSet, StatisticsChartsDataViewSet
 router = DefaultRouter()
 router.register(r'products', ProductViewSet)
 router.register(r'key-features', KeyFeatureViewSet)
 router.register(r'products-manager', ProductViewManagerSet)
 router.register(r'baskets', BasketViewSet)
+router.register(r'guest-baskets', GuestBasketViewSet, basename='guest-basket')
 router.register(r'orders', OrderViewSet,basename='order')
 router.register(r'order-items', OrderItemViewSet)
 router.register(r'coupons', CouponViewSet)
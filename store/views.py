@@ -1,23 +1,35 @@
+import json
 from datetime import date, datetime, timedelta
 from decimal import Decimal
-from django.db.models import Q
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db.models import Sum, Count
+from django.db.models import Count, Prefetch, Sum
 from django.db.models.functions import TruncMonth
 from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.decorators import action
+from rest_framework.parsers import FormParser, MultiPartParser
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from rest_framework.exceptions import AuthenticationFailed
 from api.models import User
+from .catalog import catalog_snapshot_response, invalidate_catalog
+from .filters import OrderStatusFilter, ProductFacetFilter, ProductOrderingFilter, ProductPriceFilter, facet_counts
+from .guest_basket import add_guest_items, create_guest_basket, delete_guest_basket, get_guest_basket, merge_guest_basket
+from .idempotency import IDEMPOTENCY_HEADER, IdempotencyError, begin_request, complete_request
+from .inventory import InsufficientInventory, merge_lines, reserve_stock
+from .orders import create_order_from_basket, create_order_items, lines_total, lock_prices, transition_orders
+from .pagination import OrderHistoryCursorPagination, ProductCursorPagination
+from .payment_outbox import enqueue_payment
+from .product_io import export_xlsx, import_products, stream_csv
+from .search import SEARCH_MAX_RESULTS, search_product_ids
 from .paymentMyFatorah import check_payment_status, get_all_payments, get_payment_token
-from .models import Address, City, KeyFeature, Product, Basket, BasketItem, Order, OrderItem, Coupon
-from .serializers import AddressSerializer, CheckoutSerializer, CitySerializer, KeyFeatureSerializer, PaymentSerializer, ProductSerializer, BasketSerializer, BasketItemSerializer, OrderSerializer, OrderItemSerializer, CouponSerializer, CreateOrderSerializer, StatisticsChartSerializer
+from .models import Address, City, KeyFeature, Product, Basket, Order, OrderItem, Coupon
+from .serializers import AddressSerializer, CheckoutSerializer, CitySerializer, KeyFeatureSerializer, PaymentSerializer, ProductSerializer, BasketSerializer, BasketItemSerializer, OrderSerializer, OrderItemSerializer, CouponSerializer, ProductBulkUpdateSerializer, ProductPositionSerializer, StatisticsChartSerializer, field_requested
 from rest_framework_jwt.utils import jwt_decode_handler
-from .models import Order, Payment        
+from .models import Order, Payment, PaymentRequest        
 from django.views import View
-from django.http import JsonResponse
+from django.http import FileResponse, JsonResponse, StreamingHttpResponse
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 
@@ -42,13 +54,75 @@ def get_user_from_token(token):
         # Return response if user does not exist
         return Response({"authenticated": False, "message": "Token not provided"}, status=status.HTTP_404_NOT_FOUND)
 
-class ProductViewSet(viewsets.ModelViewSet):
-    queryset = Product.objects.filter(Q(inventory_count__gt=0))
+class ProductQuerysetMixin:
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if not field_requested(self.request, 'key_features'):
+            queryset = queryset.prefetch_related(None)
+        return queryset
+
+BATCH_MAX_IDS = 100
+
+class ProductViewSet(ProductQuerysetMixin, viewsets.ModelViewSet):
+    # Prefetch key features so listing the catalog costs a fixed number of queries
+    # In-stock / active filtering is done by ProductFacetFilter (on by default)
+    queryset = Product.objects.prefetch_related('key_features')
     serializer_class = ProductSerializer
+    pagination_class = ProductCursorPagination
+    filter_backends = [ProductFacetFilter, ProductPriceFilter, ProductOrderingFilter]
+    ordering = ['position']
+
+    def list(self, request, *args, **kwargs):
+        # Served from a snapshot rebuilt only after a Product or KeyFeature changes
+        return catalog_snapshot_response(request, lambda: super(ProductViewSet, self).list(request, *args, **kwargs).data)
+
+    @action(detail=False, methods=['get'])
+    def facets(self, request):
+        def render_facets():
+            queryset = ProductPriceFilter().filter_queryset(request, Product.objects.all(), self)
+            return facet_counts(queryset, request)
+        return catalog_snapshot_response(request, render_facets)
+
+    @action(detail=False, methods=['get'])
+    def batch(self, request):
+        # Basket / order rendering: many products in one call, whatever their stock state
+        try:
+            product_ids = list(dict.fromkeys(int(product_id) for product_id in request.query_params.get('ids', '').split(',') if product_id.strip()))
+        except ValueError:
+            return Response({'detail': 'ids must be a comma separated list of integers'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(product_ids) > BATCH_MAX_IDS:
+            return Response({'detail': f'At most {BATCH_MAX_IDS} ids per request'}, status=status.HTTP_400_BAD_REQUEST)
+
+        products = self.get_queryset().in_bulk(product_ids)
+        found = [products[product_id] for product_id in product_ids if product_id in products]
+        serializer = self.get_serializer(found, many=True)
+        missing = [product_id for product_id in product_ids if product_id not in products]
+        return Response({'results': serializer.data, 'missing': missing})
 
-class ProductViewManagerSet(viewsets.ModelViewSet):
-    queryset = Product.objects.all()
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        query = request.query_params.get('q', '').strip()
+        try:
+            limit = int(request.query_params.get('limit', SEARCH_MAX_RESULTS))
+        except ValueError:
+            return Response({'detail': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1:
+            return Response({'detail': 'limit must be at least 1'}, status=status.HTTP_400_BAD_REQUEST)
+        limit = min(limit, SEARCH_MAX_RESULTS)
+
+        # The storefront filters run inside the search query, before its LIMIT
+        queryset = self.filter_queryset(self.get_queryset())
+        product_ids = search_product_ids(query, limit, queryset)
+        products = queryset.in_bulk(product_ids)
+        # Keep the relevance order from the index
+        ranked = [products[product_id] for product_id in product_ids if product_id in products]
+        serializer = self.get_serializer(ranked, many=True)
+        return Response({'query': query, 'count': len(ranked), 'results': serializer.data})
+
+class ProductViewManagerSet(ProductQuerysetMixin, viewsets.ModelViewSet):
+    queryset = Product.objects.prefetch_related('key_features')
     serializer_class = ProductSerializer
+    pagination_class = ProductCursorPagination
 
     def update(self, request, *args, **kwargs):
         try:
@@ -68,6 +142,93 @@ class ProductViewManagerSet(viewsets.ModelViewSet):
             print(f"Error during saving the product: {e}")
             raise e 
 
+    @action(detail=False, methods=['post'])
+    def reorder(self, request):
+        if not isinstance(request.data, dict):
+            return Response({'error': 'Expected an object with a positions list'}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = ProductPositionSerializer(data=request.data.get('positions', []), many=True)
+        serializer.is_valid(raise_exception=True)
+        positions = {entry['id']: entry['position'] for entry in serializer.validated_data}
+        if len(positions) != len(serializer.validated_data):
+            return Response({'error': 'Each product may only appear once'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            moved = Product.bulk_reorder(positions)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        # Batched updates skip the model signals
+        invalidate_catalog()
+        return Response({'status': 'success', 'moved': moved})
+
+    @action(detail=False, methods=['post'], url_path='bulk-update')
+    def bulk_update(self, request):
+        if not isinstance(request.data, dict):
+            return Response({'error': 'Expected an object with a products list'}, status=status.HTTP_400_BAD_REQUEST)
+        rows = request.data.get('products', [])
+        if not isinstance(rows, list) or not rows:
+            return Response({'error': 'products must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = [None] * len(rows)
+        patches = {}
+        for index, row in enumerate(rows):
+            serializer = ProductBulkUpdateSerializer(data=row)
+            if not serializer.is_valid():
+                results[index] = {'id': row.get('id') if isinstance(row, dict) else None, 'status': 'error', 'errors': serializer.errors}
+                continue
+            patch = dict(serializer.validated_data)
+            product_id = patch.pop('id')
+            if product_id in patches:
+                results[index] = {'id': product_id, 'status': 'error', 'errors': {'id': ['Duplicate id in request.']}}
+                continue
+            patches[product_id] = patch
+            results[index] = {'id': product_id}
+
+        updated = Product.bulk_patch(patches) if patches else set()
+        for result in results:
+            if 'status' not in result:
+                result['status'] = 'updated' if result['id'] in updated else 'error'
+                if result['status'] == 'error':
+                    result['errors'] = {'id': ['Product not found.']}
+        if updated:
+            # Batched updates skip the model signals
+            invalidate_catalog()
+        return Response({'updated': len(updated), 'results': results})
+
+    @action(detail=False, methods=['get'], url_path='export')
+    def export_catalog(self, request):
+        # `format` is taken by DRF's renderer override, hence `file_type`
+        file_type = request.query_params.get('file_type', 'csv')
+        if file_type == 'xlsx':
+            return FileResponse(
+                export_xlsx(),
+                as_attachment=True,
+                filename='products.xlsx',
+                content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            )
+        if file_type != 'csv':
+            return Response({'error': 'file_type must be csv or xlsx'}, status=status.HTTP_400_BAD_REQUEST)
+        response = StreamingHttpResponse(stream_csv(), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="products.csv"'
+        return response
+
+    @action(detail=False, methods=['post'], url_path='import', parser_classes=[MultiPartParser, FormParser])
+    def import_catalog(self, request):
+        uploaded_file = request.FILES.get('file')
+        if not uploaded_file:
+            return Response({'error': 'file is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        file_type = request.data.get('file_type') or uploaded_file.name.rsplit('.', 1)[-1].lower()
+        if file_type not in ('csv', 'xlsx'):
+            return Response({'error': 'file_type must be csv or xlsx'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            report = import_products(uploaded_file, file_type)
+        except Exception as e:
+            print(f"Error importing products: {e}")
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        report['status'] = 'partial' if report['errors'] else 'success'
+        return Response(report)
+
 
 
 class KeyFeatureViewSet(viewsets.ModelViewSet):
@@ -92,49 +253,126 @@ class KeyFeatureViewSet(viewsets.ModelViewSet):
         
         
 class BasketViewSet(viewsets.ModelViewSet):
-    queryset = Basket.objects.all()
+    queryset = Basket.objects.with_totals().prefetch_related('items')
     serializer_class = BasketSerializer
 
     @action(detail=True, methods=['post'])
     def add_to_basket(self, request, pk=None):
         basket = self.get_object()
-        product = get_object_or_404(Product, id=request.data['product_id'])
-        quantity = request.data.get('quantity', 1)
+        try:
+            [(product_id, quantity)] = merge_lines([request.data['product_id']], [request.data.get('quantity', 1)]).items()
+        except (KeyError, TypeError, ValueError) as e:
+            return Response({'detail': f'Invalid item: {e}'}, status=status.HTTP_400_BAD_REQUEST)
+        product = get_object_or_404(Product, id=product_id)
         if product.inventory_count < quantity:
             return Response({'detail': 'Insufficient inventory'}, status=status.HTTP_400_BAD_REQUEST)
-        basket_item, created = BasketItem.objects.get_or_create(
-            basket=basket,
-            product=product,
-            defaults={'quantity': quantity}
-        )
-        if not created:
-            basket_item.quantity += quantity
-            basket_item.save()
+        basket.add_items({product.id: quantity})
         return Response({'detail': 'Item added to basket'})
 
+    @action(detail=True, methods=['post'], url_path='upsert-items')
+    def upsert_items(self, request, pk=None):
+        basket = self.get_object()
+        items = request.data.get('items', [])
+        if not isinstance(items, list) or not items:
+            return Response({'detail': 'items must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            lines = merge_lines([item['product_id'] for item in items], [item.get('quantity', 1) for item in items])
+        except (KeyError, TypeError, ValueError) as e:
+            return Response({'detail': f'Invalid items: {e}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # One query for every product in the request
+        available = dict(Product.objects.filter(id__in=lines.keys()).values_list('id', 'inventory_count'))
+        failed = []
+        for product_id, quantity in list(lines.items()):
+            if product_id not in available:
+                failed.append({'product_id': product_id, 'detail': 'Product not found'})
+            elif available[product_id] < quantity:
+                failed.append({'product_id': product_id, 'detail': 'Insufficient inventory'})
+            else:
+                continue
+            del lines[product_id]
+
+        basket.add_items(lines)
+        added = [{'product_id': product_id, 'quantity': quantity} for product_id, quantity in lines.items()]
+        return Response({'detail': 'Basket updated', 'added': added, 'failed': failed},
+                        status=status.HTTP_200_OK if added else status.HTTP_400_BAD_REQUEST)
+
     @action(detail=True, methods=['post'])
     def create_order(self, request, pk=None):
         basket = self.get_object()
-        if basket.items.count() == 0:
-            return Response({'detail': 'Basket is empty'}, status=status.HTTP_400_BAD_REQUEST)
-        
-        order_data = {
-            'user': basket.user.id,
-            'total_amount': basket.total_price()
-        }
-        order_serializer = CreateOrderSerializer(data=order_data)
-        if order_serializer.is_valid():
-            order = order_serializer.save()
-            for item in basket.items.all():
-                OrderItem.objects.create(
-                    order=order,
-                    product=item.product,
-                    price=item.product.get_effective_price(),
-                    quantity=item.quantity
-                )
-            basket.items.all().delete()
-            return Response(OrderSerializer(order).data)
-        return Response(order_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            order = create_order_from_basket(basket)
+        except InsufficientInventory as e:
+            return Response({'detail': str(e), 'failed_lines': e.failures}, status=status.HTTP_400_BAD_REQUEST)
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(OrderSerializer(order).data)
+
+class GuestBasketViewSet(viewsets.ViewSet):
+    # Baskets for visitors who are not logged in, kept in the cache only
+    lookup_field = 'token'
+    lookup_value_regex = '[A-Za-z0-9_-]+'
+
+    def guest_basket_response(self, token, lines, status_code=status.HTTP_200_OK):
+        items = [{'product_id': product_id, 'quantity': quantity} for product_id, quantity in lines.items()]
+        return Response({'token': token, 'items': items}, status=status_code)
+
+    def create(self, request):
+        token = create_guest_basket()
+        return self.guest_basket_response(token, {}, status.HTTP_201_CREATED)
+
+    def retrieve(self, request, token=None):
+        lines = get_guest_basket(token)
+        if lines is None:
+            return Response({'detail': 'Basket not found or expired'}, status=status.HTTP_404_NOT_FOUND)
+        return self.guest_basket_response(token, lines)
+
+    def destroy(self, request, token=None):
+        delete_guest_basket(token)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=True, methods=['post'])
+    def items(self, request, token=None):
+        items = request.data.get('items', [])
+        if not isinstance(items, list) or not items:
+            return Response({'detail': 'items must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            lines = merge_lines([item['product_id'] for item in items], [item.get('quantity', 1) for item in items])
+        except (KeyError, TypeError, ValueError) as e:
+            return Response({'detail': f'Invalid items: {e}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Read-only check; guest baskets never write to the database
+        available = dict(Product.objects.filter(id__in=lines.keys()).values_list('id', 'inventory_count'))
+        failed = [
+            {'product_id': product_id, 'detail': 'Product not found' if product_id not in available else 'Insufficient inventory'}
+            for product_id, quantity in lines.items()
+            if available.get(product_id, 0) < quantity
+        ]
+        for line in failed:
+            del lines[line['product_id']]
+
+        basket = add_guest_items(token, lines)
+        if basket is None:
+            return Response({'detail': 'Basket not found or expired'}, status=status.HTTP_404_NOT_FOUND)
+        response = self.guest_basket_response(token, basket)
+        response.data['failed'] = failed
+        return response
+
+    @action(detail=True, methods=['post'])
+    def merge(self, request, token=None):
+        try:
+            token_header = request.META.get('HTTP_AUTHORIZATION', '').split(' ')[1]
+            user = get_user_from_token(token_header)
+            if not isinstance(user, User):
+                raise AuthenticationFailed('Invalid token.')
+        except Exception as e:
+            print('Token error:', e)
+            raise AuthenticationFailed('Invalid token.')
+
+        basket = merge_guest_basket(user, token)
+        if basket is None:
+            return Response({'detail': 'Nothing to merge'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(BasketSerializer(basket).data)
 
 class CouponViewSet(viewsets.ModelViewSet):
     queryset = Coupon.objects.all()
@@ -174,15 +412,46 @@ class OrderItemViewSet(viewsets.ModelViewSet):
     serializer_class = OrderItemSerializer
     
     
-from django.db import transaction, IntegrityError
+from django.db import transaction
 
 
 
 class OrderViewSet(viewsets.ModelViewSet):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
+    filter_backends = [OrderStatusFilter]
+
+    def get_queryset(self):
+        # Join the user and payment, prefetch items with their products, so a
+        # page of orders costs the same few queries whatever its size
+        queryset = super().get_queryset().select_related('user')
+        if field_requested(self.request, 'items'):
+            queryset = queryset.prefetch_related(Prefetch('items', queryset=OrderItem.objects.select_related('product').order_by('id')))
+        if field_requested(self.request, 'last_payment') or field_requested(self.request, 'all_payments'):
+            queryset = queryset.select_related('payment')
+        return queryset
 
     def create(self, request):
+        # Retries carrying the same Idempotency-Key get the stored response
+        # instead of a second order, stock hold and invoice
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return self.place_order(request)
+        try:
+            record = begin_request('order-create', key, request.user.id, request.data)
+        except IdempotencyError as e:
+            return Response({'status': 'error', 'message': str(e)}, status=e.status_code)
+        if record.response is not None:
+            return Response(record.response, status=record.status_code, headers={'Idempotent-Replayed': 'true'})
+        try:
+            response = self.place_order(request)
+        except Exception:
+            complete_request(record, status.HTTP_500_INTERNAL_SERVER_ERROR, None)
+            raise
+        complete_request(record, response.status_code, response.data)
+        return response
+
+    def place_order(self, request):
         user = request.user
         print(request.data)
         products = request.data.get('products', [])
@@ -193,58 +462,71 @@ class OrderViewSet(viewsets.ModelViewSet):
         if not products or not quantities or len(products) != len(quantities):
             return Response({'status': 'error', 'message': 'Invalid data'}, status=status.HTTP_400_BAD_REQUEST)
 
-        total_amount = 0
-        
+        try:
+            lines = merge_lines(products, quantities)
+        except (TypeError, ValueError) as e:
+            return Response({'status': 'error', 'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
         try:
             with transaction.atomic():
-                order = Order.objects.create(user=user, total_amount=total_amount)
-                print("Step 1: Order created successfully.")
+                # One locked read for every price, then one conditional update for the stock
+                prices = lock_prices(lines.keys())
+                reserve_stock(lines)
+                address = Address.objects.select_related('city').get(id=shippingAddress['id'])
 
-                for product_id, quantity in zip(products, quantities):
-                    product = Product.objects.get(id=product_id)
-                    price = product.get_effective_price()
-                    quantity = int(quantity)
-                    
-                    # Check if sufficient inventory is available (if needed)
-                    if product.inventory_count < quantity:
-                        raise ValueError(f"Insufficient inventory for product {product.name}")
-                    
-                    # Create order item and update inventory
-                    try:
-                        OrderItem.objects.create(order=order, product=product, price=price, quantity=quantity)
-                        total_amount += price * quantity
-                        product.inventory_count -= quantity
-                        product.save()
-                        print(f"Step 2: Order item created for product {product.name}.")
-                    except IntegrityError as e:
-                        # Handle database integrity errors (e.g., duplicate entries) if necessary
-                        raise ValueError(f"Error creating order item: {str(e)}")
-                shipment_fee = Decimal(shippingAddress['city']['shipment_fee'])
+                total_amount = lines_total(lines, prices)
+                shipment_fee = address.city.shipment_fee
                 total_amount_with_shipment_fee = total_amount + shipment_fee 
                 taxes = total_amount_with_shipment_fee * Decimal('0.01')
-                # print(taxes)
-                order.total_amount = total_amount + taxes
-                order.shipping_address = Address.objects.get(id=shippingAddress['id'])
-                order.save()
-                print("Step 3: Order total amount updated.")
-
-                # # Get the final payment token
-                # final_token = get_payment_token(order.total_amount*100)
-                # print("Final token for payment:", final_token)
-                # print("Step 4: Payment token retrieved.")
-                
-                # Construct the payment URL
-                print(order.total_amount)
-                print(order.id)
-                payment_url = get_payment_token(order.total_amount*100 ,order.id, order.user.username)
-                print("Step 5: Payment URL constructed.")
-                
-                return Response({'status': 'success','customer_name':order.user.username, 'order_id': order.id,'amount':order.total_amount*100, 'url_payment': payment_url}, status=status.HTTP_201_CREATED)
+                # The order row is written once, already carrying its final total
+                order = Order.objects.create(user=user, total_amount=total_amount + taxes, shipping_address=address)
+                create_order_items(order, lines, prices)
+                print("Step 1: Order created successfully.")
+
+                # The gateway invoice is created after commit so the write
+                # lock is not held for the gateway round trip
+                payment_request = enqueue_payment(order)
 
+        except InsufficientInventory as e:
+            return Response({'status': 'error', 'message': str(e), 'failed_lines': e.failures}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             print(e)
             return Response({'status': 'error', 'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
-        
+
+        # With inline payments the invoice may already exist, otherwise the client polls payment-link
+        payment_request.refresh_from_db()
+        return Response({'status': 'success','customer_name':user.username, 'order_id': order.id,'amount':order.total_amount*100, 'url_payment': payment_request.payment_url, 'payment_status': payment_request.status}, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['post'])
+    def transitions(self, request):
+        # {"transition": "package", "ids": [1, 2, 3]} moves every allowed order in one statement
+        order_ids = request.data.get('ids', [])
+        if not isinstance(order_ids, list) or not order_ids:
+            return Response({'status': 'error', 'message': 'ids must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            outcomes = transition_orders(order_ids, request.data.get('transition'))
+        except (TypeError, ValueError) as e:
+            return Response({'status': 'error', 'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        updated = sum(1 for outcome in outcomes if outcome['status'] == 'updated')
+        return Response({'status': 'success', 'updated': updated, 'results': outcomes})
+
+    @action(detail=False, methods=['get'])
+    def mine(self, request):
+        # Order history of the calling customer only, keyset paginated
+        queryset = self.filter_queryset(self.get_queryset().filter(user=request.user))
+        paginator = OrderHistoryCursorPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = self.get_serializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=True, methods=['get'], url_path='payment-link')
+    def payment_link(self, request, pk=None):
+        order = self.get_object()
+        payment_request = PaymentRequest.objects.filter(order=order).first()
+        if payment_request is None:
+            return Response({'status': 'error', 'message': 'No payment request for this order'}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'order_id': order.id, 'payment_status': payment_request.status, 'url_payment': payment_request.payment_url})
+
         # List orders
     def list(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
@@ -289,9 +571,11 @@ class OrderViewSet(viewsets.ModelViewSet):
 class OrderStatisticsViewSet(viewsets.ViewSet):
     
     def list(self, request):
-        today = date.today()
+        today = timezone.localdate()
         total_orders = Order.objects.count()
-        todays_orders = Order.objects.filter(created_at__date=today).count()
+        # A range instead of created_at__date so the created_at index is used
+        start_of_day = timezone.make_aware(datetime.combine(today, datetime.min.time()))
+        todays_orders = Order.objects.filter(created_at__gte=start_of_day, created_at__lt=start_of_day + timedelta(days=1)).count()
         un_packaged_orders = Order.objects.filter(paid=False,packaged=False).count()
         un_packaged_orders_paid = Order.objects.filter(paid=True,packaged=False).count()
         un_delivered_orders = Order.objects.filter(delivered=False).count()
@@ -368,6 +652,21 @@ class CheckoutViewSet(viewsets.ViewSet):
 class MyFatoorahCallbackView(View):
 
     def get(self, request, *args, **kwargs):
+        # The gateway and browsers repeat callbacks; the paymentId identifies one
+        payment_id = request.GET.get('paymentId')
+        if not payment_id:
+            return self.handle_callback(request)
+        try:
+            record = begin_request('payment-callback', payment_id, request.GET.get('order_id'), request.GET.dict())
+        except IdempotencyError as e:
+            return JsonResponse({'status': 'error', 'message': str(e)}, status=e.status_code)
+        if record.response is not None:
+            return JsonResponse(record.response, status=record.status_code)
+        response = self.handle_callback(request)
+        complete_request(record, response.status_code, json.loads(response.content))
+        return response
+
+    def handle_callback(self, request):
         try:
             print('try to get status')
             payment_id = request.GET.get('paymentId')
@@ -0,0 +1,46 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections, connections
+
+logger = logging.getLogger(__name__)
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name, max_workers):
+    """
+    Return the thread pool for `name`, creating it on first use.
+
+    :param name: Pool name, also used as the worker thread name prefix
+    :param max_workers: Size of the pool when it is created
+    """
+    with _executors_lock:
+        if name not in _executors:
+            _executors[name] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+    return _executors[name]
+
+
+def run_job(description, func, *args):
+    close_old_connections()
+    try:
+        func(*args)
+    except Exception as e:
+        logger.error(f"{description} failed: {str(e)}")
+    finally:
+        # Worker threads own their connections, release them between jobs
+        connections.close_all()
+
+
+def submit(name, max_workers, description, func, *args):
+    """
+    Run `func(*args)` on the `name` pool, or inline when `max_workers` is 0.
+
+    :param description: What the job does, used when logging a failure
+    """
+    if max_workers:
+        get_executor(name, max_workers).submit(run_job, description, func, *args)
+    else:
+        func(*args)